@@ -1 +1 @@
-from server import app, setup_funcs, rd_conn
+from server import app, setup_funcs, rd_conn, dispatcher, status_poller
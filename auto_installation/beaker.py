@@ -1,43 +1,156 @@
 import attr
 import json
 import subprocess
+import threading
 import time
 import logging
-from threading import Thread
 from .cobbler import Cobbler
-from .utils import ReserveUserWrongException, init_redis
+from .kickstarts import ks_store
+from .constants import INSTALL_TIMEOUT, INSTALL_DONE_KEY, BKR_WORKERS
+from .utils import ReserveUserWrongException, init_redis, BackgroundTasks
 
 log = logging.getLogger("Beaker")
 
 
+class RedisSubscription(object):
+    """Wait for messages published to the redis channel `ch_name`
+
+    Subscribe before the message can be sent, `next_message` then blocks on
+    the subscription until a message arrives or `timeout` seconds passed.
+    """
+
+    def __enter__(self):
+        self.subscribe()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def subscribe(self):
+        self._p = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+        self._p.subscribe(self.ch_name)
+        log.info("subscribed channel %s", self.ch_name)
+
+    def close(self):
+        if self._p is not None:
+            self._p.close()
+            self._p = None
+
+    def next_message(self):
+        """Return data of the next message, None if timed out"""
+        if self.timeout is None:
+            for msg in self._p.listen():
+                if msg['type'] == 'message':
+                    return msg['data']
+            # unsubscribed meanwhile, nothing will arrive any more
+            log.error("subscription of channel %s is over", self.ch_name)
+            return None
+
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            msg = self._p.get_message(timeout=remaining)
+            if msg and msg['type'] == 'message':
+                return msg['data']
+
+
 @attr.s
-class WatchInstallation(object):
+class ChannelWaiter(RedisSubscription):
     ch_name = attr.ib()
-    p = attr.ib()
-    redis_conn = attr.ib(default=init_redis())
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+    timeout = attr.ib(default=None)
+    _p = attr.ib(default=None, init=False)
 
-    def watch(self):
-        now = time.time()
-        while True:
-            msg = self.p.get_message(ignore_subscribe_messages=True)
-            log.info("waiting for installation message")
-            if msg:
-                log.info("get message from channel %s: %s", self.ch_name, msg)
-                with Cobbler() as cb:
-                    log.info("remove system %s from cobbler", self.ch_name)
-                    cb.remove_system(self.ch_name)
-                self.redis_conn.publish(self.ch_name, msg['data'])
-                break
-            elif (time.time() - now > 1200):
-                log.error("provision job is time-out after 20min")
-                self.redis_conn.publish(self.ch_name, 'fail')
-                break
-            time.sleep(10)
-
-
-def inst_watcher(ch_name, p):
-    ins = WatchInstallation(ch_name, p)
-    return Thread(target=ins.watch)
+
+@attr.s
+class InstallationWaiter(RedisSubscription):
+    """Wait for the `done,<ip>` message a host posts after installation
+
+    Whatever the outcome, the host is removed from cobbler afterwards so it
+    won't netboot into the installer again.
+    """
+    ch_name = attr.ib()
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+    timeout = attr.ib(default=INSTALL_TIMEOUT)
+    _p = attr.ib(default=None, init=False)
+
+    def _remove_from_cobbler(self):
+        try:
+            with Cobbler() as cb:
+                log.info("remove system %s from cobbler", self.ch_name)
+                cb.remove_system(self.ch_name)
+        except Exception as e:
+            log.error(e)
+
+    def clear_done(self):
+        """Forget the done message of an earlier installation"""
+        self.redis_conn.delete(INSTALL_DONE_KEY.format(self.ch_name))
+
+    def wait(self):
+        """Return ip of the installed host, None if failed or timed out"""
+        log.info("waiting for installation message on channel %s",
+                 self.ch_name)
+        data = self.redis_conn.get(INSTALL_DONE_KEY.format(self.ch_name))
+        if data is None:
+            data = self.next_message()
+        self._remove_from_cobbler()
+
+        if data is None:
+            log.error("provision job is time-out after %ss", self.timeout)
+            return None
+        log.info("get message from channel %s: %s", self.ch_name, data)
+        if 'done' in data:
+            return data.split(',')[1]
+        return None
+
+
+@attr.s
+class BkrResult(object):
+    """Outcome of one bkr command"""
+    action = attr.ib()
+    bkr_name = attr.ib()
+    returncode = attr.ib()
+    output = attr.ib(default='')
+    error = attr.ib(default='')
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+class BkrFuture(object):
+    """BkrResult of a bkr command which may still be running"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the command, raise what it raised, if anything"""
+        if not self._done.wait(timeout):
+            raise RuntimeError("bkr command isn't done in {}s".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+# bkr commands of all the jobs, bkr takes one system per command so actions
+# on many systems are run side by side instead
+_bkr_tasks = BackgroundTasks(BKR_WORKERS)
 
 
 @attr.s
@@ -45,40 +158,73 @@ class Beaker(object):
 
     CMDs = dict(
         # this cmd will provision the given host with rhevh ngn build
-        provision=("bkr system-provision "
-                   "--kernel-options "
+        provision=["bkr", "system-provision",
+                   "--kernel-options",
                    "inst.stage2=http://10.66.10.22:8090/"
                    "rhevh/ngn-dvd-iso/RHVH-7.2-20160718.1/stage2 "
-                   "inst.ks=http://{srv_ip}:{srv_port}/static/auto/{ks_file} "
-                   "ks= "
-                   "--distro-tree {distro_tree_id} {bkr_name}"),
+                   "inst.ks=http://{srv_ip}:{srv_port}{ks_path} "
+                   "ks=",
+                   "--distro-tree", "{distro_tree_id}", "{bkr_name}"],
 
         # this cmd will make sure the given host boot from local disk
-        clear_netboot=("bkr system-power "
-                       "--action none "
-                       "--clear-netboot {bkr_name}"),
-        power_on=("bkr system-power "
-                  "--action on {bkr_name}"),
-        power_off=("bkr system-power "
-                   "--action off {bkr_name}"),
-        reboot=("bkr system-power "
-                "--action reboot {bkr_name}"),
-        reserve="bkr system-reserve {bkr_name}",
-        release="bkr system-release {bkr_name}",
-        status="bkr system-status {bkr_name} --format json")
+        clear_netboot=["bkr", "system-power",
+                       "--action", "none",
+                       "--clear-netboot", "{bkr_name}"],
+        power_on=["bkr", "system-power",
+                  "--action", "on", "{bkr_name}"],
+        power_off=["bkr", "system-power",
+                   "--action", "off", "{bkr_name}"],
+        reboot=["bkr", "system-power",
+                "--action", "reboot", "{bkr_name}"],
+        reserve=["bkr", "system-reserve", "{bkr_name}"],
+        release=["bkr", "system-release", "{bkr_name}"],
+        status=["bkr", "system-status", "{bkr_name}", "--format", "json"])
 
     srv_ip = attr.ib(default="0.0.0.0")
     srv_port = attr.ib(default=5000)
     ks_file = attr.ib(default="")
 
+    def _run(self, cmd, bkr_name, args, future):
+        _cmd = [a.format(**args) for a in self.CMDs[cmd]]
+        try:
+            try:
+                p = subprocess.Popen(
+                    _cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError as e:
+                # like the shell does when bkr isn't there
+                ret = BkrResult(cmd, bkr_name, 127, '', str(e))
+            else:
+                out, err = p.communicate()
+                ret = BkrResult(cmd, bkr_name, p.returncode, out, err)
+            if not ret.ok:
+                log.error("%s of %s failed with return code %s: %s", cmd,
+                          bkr_name, ret.returncode, ret.error.strip())
+            future.set_result(ret)
+        except Exception as e:
+            future.set_exception(e)
+
+    def submit(self, cmd, bkr_name, args=None):
+        """Start cmd on bkr_name, return the BkrFuture of its result"""
+        args = dict(args or {}, bkr_name=bkr_name)
+        future = BkrFuture()
+        _bkr_tasks.submit(self._run, cmd, bkr_name, args, future)
+        return future
+
+    def submit_all(self, cmd, bkr_names, args=None):
+        """Start cmd on every one of bkr_names at once, return the
+        BkrFutures by bkr name"""
+        return dict((bkr_name, self.submit(cmd, bkr_name, args))
+                    for bkr_name in bkr_names)
+
     def _exec_cmd(self, cmd, bkr_name, args, output=False):
-        _cmd = self.CMDs[cmd].format(**args)
+        ret = self.submit(cmd, bkr_name, args).result()
         if not output:
-            ret = subprocess.call(_cmd, shell=True)
-            return ret
+            return ret.returncode
         else:
-            ret = subprocess.check_output(_cmd, shell=True)
-            return ret
+            if not ret.ok:
+                raise subprocess.CalledProcessError(ret.returncode, cmd,
+                                                    ret.output)
+            return ret.output
 
     def power_on(self, bkr_name):
         """pass"""
@@ -100,7 +246,7 @@ class Beaker(object):
             dict(
                 bkr_name=bkr_name,
                 distro_tree_id=distro_tree_id,
-                ks_file=self.ks_file,
+                ks_path=ks_store.url_path(self.ks_file),
                 srv_ip=self.srv_ip,
                 srv_port=self.srv_port))
 
@@ -108,6 +254,12 @@ class Beaker(object):
         """pass"""
         return self._exec_cmd('reserve', bkr_name, dict(bkr_name=bkr_name))
 
+    def reserve_all(self, bkr_names):
+        """Reserve all of bkr_names at once, return the names failed"""
+        futures = self.submit_all('reserve', bkr_names)
+        return sorted(bkr_name for bkr_name, f in futures.items()
+                      if not f.result().ok)
+
     def release(self, bkr_name):
         """pass"""
         return self._exec_cmd('release', bkr_name, dict(bkr_name=bkr_name))
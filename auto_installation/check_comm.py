@@ -1,14 +1,95 @@
+import json
 import logging
-from fabric.api import settings, run, get, put
+import pipes
+import threading
+import time
+import uuid
 from fabric.exceptions import NetworkError, CommandTimeout
 import re
-from utils import get_checkpoint_cases_map
+from utils import get_checkpoint_cases_map, run_concurrently
+from sshpool import ssh_pool, CmdResult
+from constants import CHECKPOINT_WORKERS
+from metrics import metrics
+from events import publish_event, CHECKPOINT_CHANNEL
 
 log = logging.getLogger('bender')
 
+# a checkpoint declared to run after ALL_CHECKPOINTS waits for every other one
+ALL_CHECKPOINTS = '*'
+
+# details a checkpoint notes for its record, per running checkpoint thread
+_ck_notes = threading.local()
+
+
+def checkpoint_policy(readonly=False, after=()):
+    """Declare how run_cases may schedule the decorated checkpoint
+
+    Read-only checkpoints don't change the host, so the ready ones run at
+    the same time over the shared ssh connection. The others run one by
+    one. `after` names checkpoints which have to be finished first.
+    """
+
+    def decorator(func):
+        func.ck_readonly = readonly
+        func.ck_after = after
+        return func
+
+    return decorator
+
+
+FRAME_TAG = '==zoidberg-batch=='
+
+
+def frame_cmds(cmds, nonce):
+    """Join cmds into one script which marks where each output starts/ends
+
+    Every command runs in its own shell, so a failing one doesn't stop the
+    others, and its exit code is printed into the closing marker.
+    """
+    lines = []
+    for index, cmd in enumerate(cmds):
+        lines.append("echo '{} {} begin {}'".format(FRAME_TAG, nonce, index))
+        lines.append('/bin/bash -c {} < /dev/null'.format(pipes.quote(cmd)))
+        # the output may lack a final newline, start the marker on a new line
+        lines.append("printf '\\n{} {} end {} %s\\n' \"$?\"".format(
+            FRAME_TAG, nonce, index))
+    return '\n'.join(lines)
+
+
+def parse_framed_output(output, nonce, count):
+    """Split the output of a framed script into a CmdResult per command
+
+    Commands without a closing marker get return code -1.
+    """
+    marker = re.compile(r'^{} {} (begin|end) (\d+)(?: (\d+))?\r?$'.format(
+        re.escape(FRAME_TAG), nonce))
+    outputs = [None] * count
+    codes = [-1] * count
+    current = None
+    for line in output.split('\n'):
+        m = marker.match(line)
+        if m:
+            index = int(m.group(2))
+            if m.group(1) == 'begin':
+                current = index
+                outputs[index] = []
+            else:
+                codes[index] = int(m.group(3))
+                current = None
+        elif current is not None:
+            outputs[current].append(line)
+
+    results = []
+    for lines, code in zip(outputs, codes):
+        out = '\n'.join(lines).strip() if lines else ''
+        results.append(CmdResult(out, code))
+    return results
+
 
 class CheckYoo(object):
     """"""
+    # subclasses don't call __init__, keep this one at class level
+    _results_file = None
 
     def __init__(self):
         self._host_string = None
@@ -58,50 +139,88 @@ class CheckYoo(object):
     def ksfile(self, val):
         self._ksfile = val
 
+    @property
+    def results_file(self):
+        """JSON Lines file run_cases appends a record per checkpoint to"""
+        return self._results_file
+
+    @results_file.setter
+    def results_file(self, val):
+        self._results_file = val
+
+    def note_result(self, **kwargs):
+        """Add details to the record of the checkpoint being run"""
+        notes = getattr(_ck_notes, 'notes', None)
+        if notes is not None:
+            notes.update(kwargs)
+
+    @property
+    def ssh(self):
+        return ssh_pool.session(self.host_string, self.host_user,
+                                self.host_pass)
+
+    def reset_connection(self):
+        """Drop the pooled ssh connection, the next command reconnects"""
+        ssh_pool.drop(self.host_string, self.host_user)
+
     def get_remote_file(self, remote_path, local_path):
-        with settings(
-                host_string=self.host_string,
-                user=self.host_user,
-                password=self.host_pass,
-                disable_known_hosts=True,
-                connection_attempts=120):
-            ret = get(remote_path, local_path)
-            if not ret.succeeded:
-                raise ValueError("Can't get {} from remote server:{}.".format(
-                    remote_path, self.host_string))
+        try:
+            self.ssh.get(remote_path, local_path, attempts=120)
+        except (IOError, NetworkError) as e:
+            log.error(e)
+            raise ValueError("Can't get {} from remote server:{}.".format(
+                remote_path, self.host_string))
 
     def put_remote_file(self, local_path, remote_path):
-        with settings(
-                host_string=self.host_string,
-                user=self.host_user,
-                password=self.host_pass,
-                disable_known_hosts=True,
-                connection_attempts=120):
-            ret = put(local_path, remote_path)
-            if not ret.succeeded:
-                raise ValueError("Can't put {} to remote server:{}.".format(
-                    local_path, self.host_string))
+        try:
+            self.ssh.put(local_path, remote_path, attempts=120)
+        except (IOError, NetworkError) as e:
+            log.error(e)
+            raise ValueError("Can't put {} to remote server:{}.".format(
+                local_path, self.host_string))
 
     def run_cmd(self, cmd, timeout=60):
         ret = None
         try:
-            with settings(
-                    host_string=self.host_string,
-                    user=self.host_user,
-                    password=self.host_pass,
-                    disable_known_hosts=True,
-                    connection_attempts=60):
-                ret = run(cmd, quiet=True, timeout=timeout)
-                if ret.succeeded:
-                    log.info('Run cmd "%s" succeeded', cmd)
-                    return True, ret
-                else:
-                    log.error('Run cmd "%s" failed', cmd)
-                    return False, ret
+            ret = self.ssh.run(cmd, timeout=timeout, attempts=60)
+            if ret.succeeded:
+                log.info('Run cmd "%s" succeeded', cmd)
+                return True, ret
+            else:
+                log.error('Run cmd "%s" failed', cmd)
+                return False, ret
         except Exception as e:
             log.error('Run cmd "%s" failed with exception "%s"', cmd, e)
             return False, e
 
+    def run_cmds(self, cmdmap, timeout=60):
+        """Run all commands of cmdmap in one remote call
+
+        Returns a dict with the same keys as cmdmap, each value is a
+        (succeeded, output) tuple like the one run_cmd returns, the output
+        carries the command's return_code.
+        """
+        names = list(cmdmap)
+        cmds = [cmdmap[name] for name in names]
+        nonce = uuid.uuid4().hex
+        try:
+            output = self.ssh.run(
+                frame_cmds(cmds, nonce), timeout=timeout, attempts=60)
+        except Exception as e:
+            log.error('Run cmds %s failed with exception "%s"', cmds, e)
+            return dict((name, (False, e)) for name in names)
+
+        rets = {}
+        for name, cmd, ret in zip(names, cmds,
+                                  parse_framed_output(output, nonce,
+                                                      len(cmds))):
+            if ret.succeeded:
+                log.info('Run cmd "%s" succeeded', cmd)
+            else:
+                log.error('Run cmd "%s" failed', cmd)
+            rets[name] = (ret.succeeded, ret)
+        return rets
+
     def check_strs_in_file(self, fp, strs, timeout):
         log.info("start to check if %s in %s", strs, fp)
         try:
@@ -190,8 +309,93 @@ class CheckYoo(object):
         finally:
             log.info("Run checkpoint:%s for cases:%s finished.", checkpoint, cases)
 
+    def _checkpoint_policy(self, checkpoint):
+        func = getattr(self, checkpoint.lower(), None)
+        return (getattr(func, 'ck_readonly', False),
+                getattr(func, 'ck_after', ()))
+
+    def schedule_checkpoints(self, checkpoints):
+        """Order checkpoints into stages, the members of a stage may run
+        concurrently, stages run one after another
+
+        Ready read-only checkpoints are grouped into one stage before the
+        next mutating one gets a stage of its own. Names are sorted so the
+        schedule is the same on every run.
+        """
+        policies = dict((ck, self._checkpoint_policy(ck)) for ck in checkpoints)
+        waits_all = set(
+            ck for ck, (_, after) in policies.items()
+            if after == ALL_CHECKPOINTS)
+        deps = {}
+        for ck, (_, after) in policies.items():
+            if after == ALL_CHECKPOINTS:
+                deps[ck] = set(checkpoints) - waits_all
+            else:
+                deps[ck] = set(after) & set(checkpoints)
+
+        stages = []
+        done = set()
+        pending = sorted(checkpoints)
+        while pending:
+            ready = [ck for ck in pending if deps[ck] <= done]
+            if not ready:
+                log.error("Checkpoints %s wait for each other, run in order",
+                          pending)
+                ready = pending
+            readonly = [ck for ck in ready if policies[ck][0]]
+            stage = readonly or ready[:1]
+            stages.append(stage)
+            done.update(stage)
+            pending = [ck for ck in pending if ck not in done]
+        return stages
+
+    def _run_checkpoint_alone(self, checkpoint_cases):
+        checkpoint, cases = checkpoint_cases
+        cks = {}
+        _ck_notes.notes = {}
+        start = time.time()
+        try:
+            self.run_checkpoint(checkpoint, cases, cks)
+        finally:
+            notes, _ck_notes.notes = _ck_notes.notes, None
+
+        duration = time.time() - start
+        metrics.record('checkpoint/' + checkpoint, duration)
+
+        if not cks:
+            status = 'error'
+        elif 'failed' in cks.values():
+            status = 'failed'
+        else:
+            status = 'passed'
+        metrics.incr('checkpoints/' + status)
+        record = dict(
+            checkpoint=checkpoint,
+            cases=cks,
+            status=status,
+            duration=round(duration, 3),
+            **notes)
+        publish_event(CHECKPOINT_CHANNEL,
+                      dict(record, ks=self.ksfile, host=self.beaker_name))
+        return cks, record
+
+    def _write_results(self, records):
+        if not self.results_file:
+            return
+        run_id = uuid.uuid4().hex
+        lines = []
+        for record in records:
+            record.update(run_id=run_id, ks=self.ksfile, host=self.beaker_name)
+            lines.append(json.dumps(record) + '\n')
+        try:
+            with open(self.results_file, 'a') as fp:
+                fp.write(''.join(lines))
+        except IOError as e:
+            log.error(e)
+
     def run_cases(self):
         cks = {}
+        records = []
         try:
             # get checkpoint cases map
             checkpoint_cases_map = get_checkpoint_cases_map(self.ksfile,
@@ -200,17 +404,25 @@ class CheckYoo(object):
             # run check
             log.info("Start to run check points, please wait...")
 
-            roll_back_cases = None
-            for checkpoint, cases in checkpoint_cases_map.items():
-                if checkpoint == "roll_back_check":
-                    roll_back_cases = cases
-                    continue
-                self.run_checkpoint(checkpoint, cases, cks)
-            if roll_back_cases:
-                self.run_checkpoint("roll_back_check", roll_back_cases, cks)
+            for stage in self.schedule_checkpoints(checkpoint_cases_map):
+                stage_cases = [(ck, checkpoint_cases_map[ck]) for ck in stage]
+                if len(stage) > 1:
+                    log.info("Run read-only checkpoints %s concurrently", stage)
+                    rets = run_concurrently(self._run_checkpoint_alone,
+                                            stage_cases, CHECKPOINT_WORKERS)
+                else:
+                    rets = [self._run_checkpoint_alone(stage_cases[0])]
+
+                # merged in stage order, whichever checkpoint finished first
+                for ret in rets:
+                    if isinstance(ret, tuple):
+                        cks.update(ret[0])
+                        records.append(ret[1])
         except Exception as e:
             log.error(e)
 
+        # one write per run, so a run is never half recorded
+        self._write_results(records)
         return cks
 
     def go_check(self):
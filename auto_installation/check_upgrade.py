@@ -3,8 +3,7 @@ import requests
 import os
 import time
 import re
-from fabric.network import disconnect_all
-from check_comm import CheckYoo
+from check_comm import CheckYoo, checkpoint_policy, ALL_CHECKPOINTS
 from constants import KS_FILES_DIR, DELL_PET105_01, DELL_PER510_01, DELL_PER515_01
 from const_upgrade import CHECK_NEW_LVS, RHVM_DATA_MAP, \
     RHVH_UPDATE_RPM_URL, \
@@ -744,6 +743,7 @@ class CheckUpgrade(CheckYoo):
     #################
     # checks in cases
     #################
+    # asks rhvm for the host too, RhevmAction isn't known to be thread safe
     def basic_upgrade_check(self):
         # To check imgbase w, imgbase layout, cockpit connection
         ck01 = self._check_imgbase_w()
@@ -754,12 +754,14 @@ class CheckUpgrade(CheckYoo):
 
         return ck01 and ck02 and ck03 and ck04 and ck05
 
+    @checkpoint_policy(readonly=True)
     def packages_check(self):
         ck01 = self._check_imgbased_ver()
         ck02 = self._check_update_ver()
 
         return ck01 and ck02
 
+    @checkpoint_policy(readonly=True)
     def settings_check(self):
         ck01 = self.check_strs_in_file(
             self._add_file_name, [self._add_file_content],
@@ -770,6 +772,7 @@ class CheckUpgrade(CheckYoo):
 
         return ck01 and ck02
 
+    @checkpoint_policy(after=ALL_CHECKPOINTS)
     def roll_back_check(self):
         log.info("Roll back.")
 
@@ -811,12 +814,14 @@ class CheckUpgrade(CheckYoo):
         else:
             return False
 
+    @checkpoint_policy(readonly=True)
     def cmds_check(self):
         ck01 = self._check_lvs()
         ck02 = self._check_findmnt()
 
         return ck01 and ck02
 
+    @checkpoint_policy(readonly=True)
     def signed_check(self):
         cmd = "rpm -qa --qf '%{{name}}-%{{version}}-%{{release}}.%{{arch}} (%{{SIGPGP:pgpsig}})\n' | " \
             "grep -v 'Key ID' | " \
@@ -843,6 +848,7 @@ class CheckUpgrade(CheckYoo):
                 "The source build is 4.0, no need to check user space rpm.")
         return self._check_user_space_rpm()
 
+    @checkpoint_policy(readonly=True)
     def avc_denied_check(self):
         log.info("Start to check avc denied errors.")
 
@@ -877,12 +883,15 @@ class CheckUpgrade(CheckYoo):
     def ovirt_imageio_daemon_check(self):
         return self._check_ovirt_imageio_daemon_status()
 
+    @checkpoint_policy(readonly=True)
     def boot_dmesg_log_check(self):
         return self._check_boot_dmesg_log()
 
+    @checkpoint_policy(readonly=True)
     def separate_volumes_check(self):
         return self._check_separate_volumes()
 
+    @checkpoint_policy(readonly=True)
     def etc_var_file_update_check(self):
         ck01 = self.check_strs_in_file(
             self._add_file_name, [self._add_file_content],
@@ -937,6 +946,7 @@ class CheckUpgrade(CheckYoo):
 
     ## added by wujian, upgrade tier2 checks
     # 1-fips check
+    @checkpoint_policy(readonly=True)
     def fips_check(self):
         return self.check_strs_in_file(
             '/proc/sys/crypto/fips_enabled', ['1'], timeout=300)
@@ -1490,7 +1500,7 @@ class CheckUpgrade(CheckYoo):
             cmd = "systemctl reboot"
             self.run_cmd(cmd, timeout=10)
 
-        disconnect_all()
+        self.reset_connection()
         count = 0
         while (count < ENTER_SYSTEM_MAXCOUNT):
             time.sleep(ENTER_SYSTEM_INTERVAL)
@@ -1658,8 +1668,8 @@ class CheckUpgrade(CheckYoo):
             "bond_ip": "ip -f inet addr show | grep 'inet 10' | awk '{print $2}'|awk -F '/' '{print $1}'",
         }
 
-        for k, v in cmdmap.items():
-            ret = self.run_cmd(v, timeout=FABRIC_TIMEOUT)
+        rets = self.run_cmds(cmdmap, timeout=FABRIC_TIMEOUT)
+        for k, ret in rets.items():
             if ret[0]:
                 check_infos[k] = ret[1]
                 log.info("***%s***:\n%s", k, ret[1])
@@ -1670,7 +1680,7 @@ class CheckUpgrade(CheckYoo):
         return True
 
     def go_check(self):
-        disconnect_all()
+        self.reset_connection()
         cks = {}
         try:
             if not self._collect_infos('old'):
@@ -3,7 +3,6 @@ import requests
 import os
 import time
 import re
-from fabric.network import disconnect_all
 from check_comm import CheckYoo
 from constants import KS_FILES_DIR, DELL_PET105_01, DELL_PER510_01, DELL_PER515_01
 from const_upgrade import CHECK_NEW_LVS, RHVM_DATA_MAP, \
@@ -1053,7 +1052,7 @@ class CheckUpgrade(CheckYoo):
             cmd = "systemctl reboot"
             self.run_cmd(cmd, timeout=10)
 
-        disconnect_all()
+        self.reset_connection()
         count = 0
         while (count < ENTER_SYSTEM_MAXCOUNT):
             time.sleep(ENTER_SYSTEM_INTERVAL)
@@ -1208,7 +1207,7 @@ class CheckUpgrade(CheckYoo):
         return True
 
     def go_check(self):
-        disconnect_all()
+        self.reset_connection()
         cks = {}
         try:
             if not self._collect_infos('old'):
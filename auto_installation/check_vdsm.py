@@ -2,10 +2,9 @@ import logging
 import re
 import time
 import functools
-from fabric.api import settings, run, local
-from fabric.network import disconnect_all
+from fabric.api import local
 from check_comm import CheckYoo
-from utils import get_checkpoint_cases_map
+from sshpool import ssh_pool
 from vdsmapi import RhevmAction
 from const_vdsm import RHVM_INFO, MACHINE_INFO, NFS_INFO, DELL_PER515_01
 
@@ -402,11 +401,7 @@ class CheckVdsm(CheckYoo):
     def _clean_nfs_path(self, nfs_ip, nfs_pass, nfs_data_path):
         log.info("Cleaning the nfs path")
         cmd = "rm -rf %s/*" % nfs_data_path
-        with settings(
-            warn_only=True,
-            host_string='root@' + nfs_ip,
-            password=nfs_pass):
-            ret = run(cmd)
+        ret = ssh_pool.session(nfs_ip, 'root', nfs_pass).run(cmd)
         if ret.failed:
             raise RuntimeError("Failed to cleanup the nfs path %s" % nfs_data_path)
 
@@ -1190,27 +1185,6 @@ GATEWAY="{gateway}"\
         except Exception as e:
             log.exception(e)
 
-    def run_cases(self):
-        cks = {}
-        try:
-            # get checkpoint cases map
-            disorder_checkpoint_cases_map = get_checkpoint_cases_map(
-                self.ksfile, self.beaker_name)
-            checkpoint_cases_map_list = sorted(
-                disorder_checkpoint_cases_map.items(), key=lambda item: item[0])
-
-            # run check
-            log.info("Start to run check points, please wait...")
-
-            for l in checkpoint_cases_map_list:
-                checkpoint = l[0]
-                cases = l[1]
-                self.run_checkpoint(checkpoint, cases, cks)
-        except Exception as e:
-            log.exception(e)
-
-        return cks
-
     def run_checkpoint(self, checkpoint, cases, cks):
         try:
             log.info("Start to run checkpoint:%s for cases:%s", checkpoint, cases)
@@ -1229,7 +1203,7 @@ GATEWAY="{gateway}"\
             log.info("Run checkpoint:%s for cases:%s finished.", checkpoint, cases)
 
     def go_check(self):
-        disconnect_all()
+        self.reset_connection()
 
         is_setup_success = self._setup_before_check()
 
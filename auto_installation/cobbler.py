@@ -1,10 +1,15 @@
 import copy
+import time
+import threading
 import attr
 import xmlrpclib
 import logging
 
 from .constants import CB_API, CB_CREDENTIAL
 
+# cobbler expires a token unused for an hour, renew it well before
+TOKEN_TTL = 30 * 60
+
 
 def _cb_cred_checker(instance, attribute, value):
     if not isinstance(value, tuple) and not isinstance(value, list):
@@ -17,6 +22,12 @@ def _cb_cred_checker(instance, attribute, value):
 
 @attr.s
 class Cobbler(object):
+    """Client of the cobbler xmlrpc api
+
+    The xmlrpc proxy of each thread is kept, with its http connection, and
+    the login token is shared by all instances until it gets old, so
+    entering `with Cobbler()` once per kickstart is cheap.
+    """
     system_tpl = dict(
         name="",
         profile="",
@@ -31,6 +42,12 @@ class Cobbler(object):
     token = attr.ib(default=None)
     log = attr.ib(default=logging.getLogger("bender"))
 
+    _local = threading.local()
+    _tokens = {}
+    _tokens_lock = threading.Lock()
+    # cobbler api -> whether its server accepts system.multicall
+    _multicall = {}
+
     def __enter__(self):
         self.login()
         return self
@@ -40,17 +57,39 @@ class Cobbler(object):
 
     @property
     def proxy(self):
-        return xmlrpclib.Server(self.cb_api)
+        proxies = getattr(self._local, 'proxies', None)
+        if proxies is None:
+            proxies = self._local.proxies = {}
+        if self.cb_api not in proxies:
+            proxies[self.cb_api] = xmlrpclib.Server(self.cb_api)
+        return proxies[self.cb_api]
 
     @property
     def profiles(self):
         ret = self.proxy.get_profiles()
         return [pn['name'] for pn in ret if pn['name'].startswith('RHVH-4')]
 
-    def login(self):
-        self.token = self.proxy.login(*(self.credential))
-        self.log.info("logging into {}, get token is {}".format(self.cb_api,
-                                                                self.token))
+    def login(self, force=False):
+        key = (self.cb_api, tuple(self.credential))
+        with self._tokens_lock:
+            token, since = self._tokens.get(key, (None, 0))
+            if force or token is None or time.time() - since > TOKEN_TTL:
+                token = self.proxy.login(*(self.credential))
+                self._tokens[key] = (token, time.time())
+                self.log.info("logging into {}, get token is {}".format(
+                    self.cb_api, token))
+        self.token = token
+
+    def _with_token(self, func):
+        """Call func(), logging in again if cobbler dropped the token"""
+        try:
+            return func()
+        except xmlrpclib.Fault as e:
+            if 'token' not in e.faultString:
+                raise
+            self.log.info("token {} expired".format(self.token))
+            self.login(force=True)
+            return func()
 
     def find_system(self, name_pattern):
         self.log.info("start to querying system {}".format(name_pattern))
@@ -63,19 +102,41 @@ class Cobbler(object):
             self.log.warning("system not exists")
             return False
 
+    def _modify_and_save(self, system_id, params):
+        if self._multicall.get(self.cb_api, True):
+            mc = xmlrpclib.MultiCall(self.proxy)
+            for k, v in params.items():
+                mc.modify_system(system_id, k, v, self.token)
+            mc.save_system(system_id, self.token)
+            try:
+                # results raise the fault of the first failed call
+                list(mc())
+                return
+            except xmlrpclib.Fault as e:
+                if 'multicall' not in e.faultString:
+                    raise
+                self.log.info("{} has no multicall".format(self.cb_api))
+                self._multicall[self.cb_api] = False
+
+        for k, v in params.items():
+            self.proxy.modify_system(system_id, k, v, self.token)
+        self.proxy.save_system(system_id, self.token)
+
     def add_new_system(self, **kwargs):
-        system_id = self.proxy.new_system(self.token)
         params = copy.deepcopy(self.system_tpl)
         params.update(kwargs)
 
         self.log.info("add new host with {}".format(params))
-        for k, v in params.items():
-            self.proxy.modify_system(system_id, k, v, self.token)
 
-        self.proxy.save_system(system_id, self.token)
+        def add():
+            system_id = self.proxy.new_system(self.token)
+            self._modify_and_save(system_id, params)
+
+        self._with_token(add)
 
     def remove_system(self, system_name):
-        self.proxy.remove_system(system_name, self.token)
+        self._with_token(
+            lambda: self.proxy.remove_system(system_name, self.token))
 
 
 if __name__ == '__main__':
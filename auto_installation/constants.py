@@ -79,6 +79,29 @@ HOSTS = {
     }
 }
 
+# seconds to wait for a host to report its installation is done
+INSTALL_TIMEOUT = 1200
+# the last done message of a host is kept here too, in case it's published
+# while nobody is subscribed, e.g. during a restart of the server
+INSTALL_DONE_KEY = 'install_done:{}'
+
+# how many hosts of a job may provision and run checkpoints at the same time
+MAX_PARALLEL_HOSTS = CFGS.get('max_parallel_hosts', len(HOSTS))
+
+# how many read-only checkpoints of one host may run at the same time
+CHECKPOINT_WORKERS = CFGS.get('checkpoint_workers', 4)
+# threads of a job post-processing kickstarts while their hosts install the
+# next ones, 0 does it before the next installation starts
+POST_WORKERS = CFGS.get('post_workers', 2)
+# how many bkr commands, of all jobs, may run at the same time
+BKR_WORKERS = CFGS.get('bkr_workers', 8)
+# seconds between two polls of the beaker status of all the hosts
+HOST_STATUS_INTERVAL = CFGS.get('host_status_interval', 60)
+# cProfile the requests of the server into this directory when set
+PROFILE_DIR = CFGS.get('profile_dir')
+# checkpoint results of a kickstart, one json record per line
+CK_RESULTS_FILE = 'checkpoints.jsonl'
+
 TR_TPL = '4_1_Node_Auto_ATIKS_{}'
 TR_PROJECT_ID = 'RHEVM3'
 TR_ID = '{}_{}'
@@ -128,11 +151,14 @@ else
 fi
 
 fetch /tmp/anamon http://{srv_ip}:{srv_port}/static/anamon.py
-python /tmp/anamon --server {srv_ip} --port {srv_port} --stage pre
-
 """.format(
     srv_ip=CURRENT_IP_PORT[0], srv_port=CURRENT_IP_PORT[1])
 
+# anamon uploads the logs of this host, followed by the beaker name
+PRE_SCRIPT_ANAMON = """
+python /tmp/anamon --server %s --port %s --stage pre --name """ % (
+    CURRENT_IP_PORT[0], CURRENT_IP_PORT[1])
+
 PRE_SCRIPT_02 = """
 fetch /tmp/clean_disk http://{srv_ip}:{srv_port}/static/clean_disk.py
 python /tmp/clean_disk
@@ -144,5 +170,5 @@ NOPXE_URL = "http://lab-01.rhts.eng.pek2.redhat.com:8000/nopxe/{0}"
 CB_API = "http://10.73.60.74/cobbler_api"
 CB_CREDENTIAL = ('cobbler', 'cobbler')
 CB_PROFILE = CFGS['cb_profile']
-ARGS_TPL = ('inst.ks=http://{srv_ip}:{srv_port}/static/auto/{ks_file} '
+ARGS_TPL = ('inst.ks=http://{srv_ip}:{srv_port}{ks_path} '
             '{addition_params}')
@@ -26,7 +26,9 @@ COV_LOCAL_FINAL_RES_PATH = os.path.join(
     PROJECT_ROOT, 'logs', 'coverage')
 
 
-def upload_coverage_raw_res_from_host(ck):
+def fetch_coverage_raw_res_from_host(ck, local_tar):
+    """Download the raw results of the host into local_tar, only this
+    part needs the host"""
     # To makeup local deal path:
     if not os.path.exists(COV_LOCAL_DEAL_PATH):
         os.makedirs(COV_LOCAL_DEAL_PATH)
@@ -41,20 +43,28 @@ def upload_coverage_raw_res_from_host(ck):
 
     # To upload coverage tar file to local server
     try:
-        ck.get_remote_file(COV_HOST_RAW_RES_TAR_PATH, COV_LOCAL_DEAL_PATH)
+        ck.get_remote_file(COV_HOST_RAW_RES_TAR_PATH, local_tar)
     except Exception as e:
         log.error(e)
         return False
 
+    return True
+
+
+def extract_coverage_raw_res(local_tar):
     # To decompress coverage tar file on local server
-    cmd = "tar -zxf {} -C {}".format(COV_LOCAL_RAW_RES_TAR_PATH,
-                                     COV_LOCAL_DEAL_PATH)
+    cmd = "tar -zxf {} -C {}".format(local_tar, COV_LOCAL_DEAL_PATH)
     os.system(cmd)
 
     # To delete the coverage tar file on local server
-    cmd = "rm -f {}".format(COV_LOCAL_RAW_RES_TAR_PATH)
+    cmd = "rm -f {}".format(local_tar)
     os.system(cmd)
 
+
+def upload_coverage_raw_res_from_host(ck):
+    if not fetch_coverage_raw_res_from_host(ck, COV_LOCAL_RAW_RES_TAR_PATH):
+        return False
+    extract_coverage_raw_res(COV_LOCAL_RAW_RES_TAR_PATH)
     return True
 
 
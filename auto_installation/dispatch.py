@@ -0,0 +1,283 @@
+"""Queue of jobs waiting for their hosts, and the leases of busy hosts
+
+Jobs wait in a sorted set, highest priority first and in submission order
+within a priority. A job starts as soon as it holds a lease on every host
+its test level runs kickstarts on, so jobs on disjoint hosts run at the
+same time. Leases are renewed while the job runs and expire on their own
+if the server dies, a host is never held by a job which is gone.
+"""
+import time
+import logging
+import threading
+import attr
+
+from .utils import init_redis, get_machine_ksl_map, get_current_test_level, \
+    ResultsAndLogs
+from .journal import JobJournal, JOB_KEY_TPL
+from .jobs import JobRunner
+from .metrics import metrics
+from .events import publish_event, JOB_CHANNEL
+
+log = logging.getLogger('bender')
+
+# job ids by score, the lowest one is dispatched first
+JOB_QUEUE_KEY = 'job:queue'
+LEASE_KEY_TPL = 'lease:{}'
+LEASE_TTL = 120
+# submission times are below this, a priority step outweighs any of them
+_PRIORITY_STEP = 10 ** 10
+
+# take the leases of all the hosts, or of none if any is taken
+_ACQUIRE = """
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('set', key, ARGV[1], 'px', ARGV[2])
+end
+return 1
+"""
+
+# extend the leases still held by the job, return how many there are
+_RENEW = """
+local held = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        redis.call('pexpire', key, ARGV[2])
+        held = held + 1
+    end
+end
+return held
+"""
+
+_RELEASE = """
+for i, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        redis.call('del', key)
+    end
+end
+return 1
+"""
+
+
+@attr.s
+class HostLeases(object):
+    """Exclusive, expiring claims of jobs on beaker hosts"""
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+    ttl = attr.ib(default=LEASE_TTL)
+
+    def __attrs_post_init__(self):
+        self._acquire = self.redis_conn.register_script(_ACQUIRE)
+        self._renew = self.redis_conn.register_script(_RENEW)
+        self._release = self.redis_conn.register_script(_RELEASE)
+
+    @staticmethod
+    def _keys(hosts):
+        return [LEASE_KEY_TPL.format(h) for h in hosts]
+
+    def acquire(self, job_id, hosts):
+        """Lease all of hosts to job_id, return False if any is taken"""
+        return bool(self._acquire(
+            keys=self._keys(hosts), args=[job_id, self.ttl * 1000]))
+
+    def renew(self, job_id, hosts):
+        """Extend the leases of job_id, return the number still held"""
+        return self._renew(
+            keys=self._keys(hosts), args=[job_id, self.ttl * 1000])
+
+    def release(self, job_id, hosts):
+        self._release(keys=self._keys(hosts), args=[job_id])
+
+    def holders(self):
+        """Job ids by the hosts leased now"""
+        prefix = LEASE_KEY_TPL.format('')
+        return dict((key[len(prefix):], self.redis_conn.get(key))
+                    for key in self.redis_conn.scan_iter(prefix + '*'))
+
+
+@attr.s
+class Dispatcher(object):
+    """Starts queued jobs once their hosts are free and keeps their
+    leases alive until they finish
+
+    A job waiting for hosts also keeps them from jobs queued after it,
+    a big job isn't starved by small ones running on part of its hosts.
+    """
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+    interval = attr.ib(default=5)
+    _leases = attr.ib(default=None, init=False)
+    # job id -> hosts, of the jobs started by this dispatcher
+    _running = attr.ib(default=attr.Factory(dict), init=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False)
+    _wakeup = attr.ib(default=attr.Factory(threading.Event), init=False)
+    _thread = attr.ib(default=None, init=False)
+
+    @property
+    def leases(self):
+        if self._leases is None:
+            self._leases = HostLeases(self.redis_conn)
+        return self._leases
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def submit(self, img_url, target_build=None, test_level=None,
+               priority=0):
+        """Queue a job, return its id"""
+        if test_level is None:
+            test_level = get_current_test_level()
+        journal = JobJournal.create(
+            self.redis_conn,
+            status='queued',
+            img_url=img_url,
+            target_build=target_build or '',
+            test_level=test_level,
+            priority=priority)
+        self._enqueue(journal.job_id, priority)
+        log.info("job %s of %s is queued with priority %s", journal.job_id,
+                 img_url, priority)
+        return journal.job_id
+
+    def requeue(self, journal):
+        """Queue an unfinished job again, it goes on from its journal
+
+        Return False for a job this dispatcher is running still.
+        """
+        with self._lock:
+            if journal.job_id in self._running:
+                log.warning("job %s is running, not queued again",
+                            journal.job_id)
+                return False
+        info = journal.info
+        self.redis_conn.hset(journal.key, 'status', 'queued')
+        self._enqueue(journal.job_id, int(info.get('priority') or 0))
+        log.info("job %s of %s is queued again", journal.job_id,
+                 info['img_url'])
+        return True
+
+    def _enqueue(self, job_id, priority):
+        score = -int(priority) * _PRIORITY_STEP + time.time()
+        self.redis_conn.zadd(JOB_QUEUE_KEY, **{job_id: score})
+        self._wakeup.set()
+
+    def queued(self):
+        return self.redis_conn.zrange(JOB_QUEUE_KEY, 0, -1)
+
+    def status(self):
+        with self._lock:
+            running = dict((job_id, sorted(hosts))
+                           for job_id, hosts in self._running.items())
+        return dict(
+            queued=self.queued(), running=running,
+            leases=self.leases.holders())
+
+    @staticmethod
+    def hosts_of(info):
+        """Hosts the kickstarts of the job's test level run on"""
+        test_level = info.get('test_level')
+        test_level = int(test_level) if test_level else None
+        return set(get_machine_ksl_map(test_level))
+
+    def _loop(self):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                log.exception(e)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def tick(self):
+        """Renew the leases of running jobs, then start the queued ones
+        whose hosts are free"""
+        self._heartbeat()
+
+        blocked = set()
+        for job_id in self.queued():
+            journal = JobJournal(job_id, self.redis_conn)
+            info = journal.info
+            if not info:
+                log.error("job %s has no journal, drop it", job_id)
+                self.redis_conn.zrem(JOB_QUEUE_KEY, job_id)
+                continue
+            hosts = self.hosts_of(info)
+            if hosts & blocked or not self.leases.acquire(job_id, hosts):
+                log.debug("job %s waits for its hosts", job_id)
+                blocked |= hosts
+                continue
+            if not self.redis_conn.zrem(JOB_QUEUE_KEY, job_id):
+                # dispatched by someone else meanwhile
+                self.leases.release(job_id, hosts)
+                continue
+            self._start_job(journal, info, hosts)
+
+    def _heartbeat(self):
+        with self._lock:
+            running = list(self._running.items())
+        now = time.time()
+        for job_id, hosts in running:
+            held = self.leases.renew(job_id, hosts)
+            if held != len(hosts):
+                log.error("job %s lost %s of the leases on its hosts",
+                          job_id, len(hosts) - held)
+            self.redis_conn.hset(JOB_KEY_TPL.format(job_id), 'heartbeat', now)
+
+    def _start_job(self, journal, info, hosts):
+        results_logs = ResultsAndLogs()
+        results_logs.img_url = info['img_url']
+        if info.get('log_date'):
+            results_logs.log_stamp = (info['log_date'], info['log_time'])
+        else:
+            date, time_ = results_logs.log_stamp
+            self.redis_conn.hmset(journal.key,
+                                  dict(log_date=date, log_time=time_))
+        journal.start()
+
+        test_level = info.get('test_level')
+        runner = JobRunner(
+            info['img_url'],
+            self.redis_conn,
+            results_logs,
+            info.get('target_build') or None,
+            journal=journal,
+            test_level=int(test_level) if test_level else None)
+        t = threading.Thread(target=self._run_job, args=(runner, hosts))
+        t.setDaemon(True)
+
+        with self._lock:
+            if not self._running:
+                metrics.reset()
+            self._running[journal.job_id] = hosts
+            self.redis_conn.set('running', len(self._running))
+        log.info("start job %s of %s on hosts %s", journal.job_id,
+                 info['img_url'], ', '.join(sorted(hosts)))
+        publish_event(JOB_CHANNEL, dict(
+            job=journal.job_id, status='running', img_url=info['img_url'],
+            hosts=sorted(hosts)))
+        t.start()
+
+    def _run_job(self, runner, hosts):
+        job_id = runner.journal.job_id
+        try:
+            runner.go()
+        except Exception as e:
+            # the journal stays unfinished, the job can be resumed
+            log.exception(e)
+        finally:
+            self.leases.release(job_id, hosts)
+            with self._lock:
+                self._running.pop(job_id, None)
+                self.redis_conn.set('running', len(self._running))
+            log.info("job %s is over, its hosts are free", job_id)
+            publish_event(JOB_CHANNEL, dict(
+                job=job_id, status=runner.journal.info.get('status')))
+            self._wakeup.set()
+
+
+dispatcher = Dispatcher()
@@ -0,0 +1,116 @@
+"""Job progress pushed to the dashboards
+
+One redis subscription takes what the jobs publish anyway: installations
+done, cockpit tests, checkpoint results, jobs started and over, and host
+status changes. Every connected client gets its own bounded queue of
+them, a slow client loses its oldest events instead of holding up the
+others.
+"""
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+from constants import HOSTS
+from utils import init_redis
+
+log = logging.getLogger('bender')
+
+CHECKPOINT_CHANNEL = 'checkpoints'
+JOB_CHANNEL = 'jobs'
+HOST_STATUS_CHANNEL = 'host_status'
+
+_publish_conn = []
+
+
+def publish_event(channel, data):
+    """Publish data as json, the job goes on whatever happens"""
+    try:
+        if not _publish_conn:
+            _publish_conn.append(init_redis())
+        _publish_conn[0].publish(channel, json.dumps(data))
+    except Exception as e:
+        log.error("can't publish to %s: %s", channel, e)
+
+
+def _channel_types(hosts):
+    """Event type and host of the messages of every channel"""
+    types = {
+        CHECKPOINT_CHANNEL: ('checkpoint', None),
+        JOB_CHANNEL: ('job', None),
+        HOST_STATUS_CHANNEL: ('host_status', None),
+    }
+    for host in hosts:
+        types[host] = ('install', host)
+        types[host + '-cockpit'] = ('cockpit', host)
+        types[host + '-cockpit-result'] = ('cockpit_result', host)
+    return types
+
+
+class EventHub(object):
+    """Fans the messages of one redis subscription out to the clients"""
+
+    def __init__(self, redis_conn=None, hosts=None, maxlen=200):
+        self.redis_conn = redis_conn
+        self.maxlen = maxlen
+        self._types = _channel_types(sorted(HOSTS) if hosts is None else hosts)
+        # id -> queue, queues with the same events are equal
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _loop(self):
+        if self.redis_conn is None:
+            self.redis_conn = init_redis()
+        delay = 1
+        while True:
+            try:
+                p = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+                p.subscribe(*self._types)
+                delay = 1
+                for msg in p.listen():
+                    if msg['type'] == 'message':
+                        self.dispatch(msg['channel'], msg['data'])
+            except Exception as e:
+                log.error("event subscription failed: %s", e)
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def dispatch(self, channel, data):
+        event_type, host = self._types.get(channel, (channel, None))
+        try:
+            data = json.loads(data)
+        except ValueError:
+            # done,<ip> and the like
+            pass
+        event = dict(type=event_type, channel=channel, host=host, data=data,
+                     time=time.time())
+        with self._lock:
+            for client in self._clients.values():
+                client.append(event)
+
+    def subscribe(self):
+        """Queue receiving the events from now on, popleft() them"""
+        client = deque(maxlen=self.maxlen)
+        with self._lock:
+            self._clients[id(client)] = client
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.pop(id(client), None)
+
+    def clients(self):
+        with self._lock:
+            return len(self._clients)
+
+
+event_hub = EventHub()
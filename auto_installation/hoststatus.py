@@ -0,0 +1,110 @@
+"""Beaker status of the hosts, polled in the background and kept in redis
+
+The dashboard and the schedulers read it from redis instead of running
+`bkr system-status` themselves. Every status expires a few polls after
+it was taken, and a change of a host's status is published on
+HOST_STATUS_CHANNEL as {"host": ..., "old": ..., "new": ...}.
+"""
+import json
+import time
+import logging
+import threading
+import attr
+
+from .beaker import Beaker
+from .constants import HOSTS, HOST_STATUS_INTERVAL
+from .utils import init_redis
+from .events import HOST_STATUS_CHANNEL
+
+log = logging.getLogger('bender')
+
+HOST_STATUS_KEY_TPL = 'host_status:{}'
+
+
+def parse_status(output):
+    """Condition, reservation and loan in the output of bkr system-status,
+    bkr doesn't report the power state there"""
+    data = json.loads(output)
+    reservation = data.get('current_reservation') or {}
+    loan = data.get('current_loan') or {}
+    return dict(
+        condition=data.get('condition'),
+        reserved_by=reservation.get('user_name'),
+        recipe_id=reservation.get('recipe_id'),
+        loaned_to=loan.get('recipient'))
+
+
+@attr.s
+class HostStatusPoller(object):
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+    hosts = attr.ib(default=attr.Factory(lambda: sorted(HOSTS)))
+    interval = attr.ib(default=HOST_STATUS_INTERVAL)
+    _thread = attr.ib(default=None, init=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False)
+
+    @property
+    def ttl(self):
+        return int(self.interval * 3)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                log.exception(e)
+            time.sleep(self.interval)
+
+    def poll(self):
+        """Take the status of all the hosts at once, return the changed"""
+        futures = Beaker().submit_all('status', self.hosts)
+        changed = []
+        for host in self.hosts:
+            try:
+                ret = futures[host].result()
+                if ret.ok:
+                    status = parse_status(ret.output)
+                else:
+                    status = dict(error=ret.error.strip())
+            except Exception as e:
+                status = dict(error=str(e))
+            if self._store(host, status):
+                changed.append(host)
+        return changed
+
+    def _store(self, host, status):
+        key = HOST_STATUS_KEY_TPL.format(host)
+        old = self.redis_conn.get(key)
+        old = json.loads(old) if old else None
+        if old is not None:
+            old.pop('updated', None)
+
+        new = dict(status, updated=time.time())
+        self.redis_conn.set(key, json.dumps(new), ex=self.ttl)
+        if old == status:
+            return False
+
+        log.info("beaker status of %s changed to %s", host, status)
+        self.redis_conn.publish(
+            HOST_STATUS_CHANNEL, json.dumps(dict(host=host, old=old, new=new)))
+        return True
+
+    def status(self, host):
+        """Last status taken of host, None if it's expired"""
+        data = self.redis_conn.get(HOST_STATUS_KEY_TPL.format(host))
+        return json.loads(data) if data else None
+
+    def statuses(self):
+        keys = [HOST_STATUS_KEY_TPL.format(h) for h in self.hosts]
+        values = self.redis_conn.mget(keys) if keys else []
+        return dict((h, json.loads(v) if v else None)
+                    for h, v in zip(self.hosts, values))
+
+
+status_poller = HostStatusPoller()
@@ -1,23 +1,34 @@
-import time
 import logging
 import attr
 from threading import Thread
 import subprocess
 import os
+import time
 from .kickstarts import KickStartFiles
-from .beaker import Beaker, inst_watcher
-from .constants import CURRENT_IP_PORT, ARGS_TPL, HOSTS, CB_PROFILE, COVERAGE_TEST
+from .beaker import Beaker, ChannelWaiter, InstallationWaiter
+from .constants import CURRENT_IP_PORT, ARGS_TPL, HOSTS, CB_PROFILE, COVERAGE_TEST, \
+    MAX_PARALLEL_HOSTS, CK_RESULTS_FILE, INSTALL_TIMEOUT, POST_WORKERS
 from .const_install import KS_KERPARAMS_MAP
 from .cobbler import Cobbler
 from .check_install import CheckInstall
 from .check_upgrade import CheckUpgrade
 from .check_vdsm import CheckVdsm
 from .util_result_index import cache_logs_summary
+from .utils import run_concurrently, set_thread_test_level, BackgroundTasks, \
+    set_current_results_logs
+from .sshpool import ssh_pool
+from .metrics import Metrics, metrics, set_thread_metrics
+from .journal import JobJournal, PROVISIONED, INSTALLED, CHECKED, FAILED, \
+    DONE_PHASES
 from reports import ResultsToPolarion
-from coverage_stat import upload_coverage_raw_res_from_host, generate_final_coverage_result
+from coverage_stat import fetch_coverage_raw_res_from_host, extract_coverage_raw_res, \
+    generate_final_coverage_result, COV_LOCAL_DEAL_PATH, COV_RAW_RES_TAR_NAME
 
 log = logging.getLogger("bender")
 
+# test flag of a kickstart, by the prefix of its name
+TEST_FLAGS = {'ati': 'install', 'atu': 'upgrade', 'atv': 'vdsm'}
+
 
 @attr.s
 class JobRunner(object):
@@ -28,37 +39,34 @@ class JobRunner(object):
     # ks_filter = attr.ib(default='must')
     debug = attr.ib(default=False)
     test_flag = attr.ib(default='install')
-
-    def _wait_for_installation(self, p):
-        while True:
-            time.sleep(5)
-            log.info("waitting for install done")
-            msg = p.get_message(ignore_subscribe_messages=True)
-            if msg:
-                if 'done' in msg['data']:
-                    log.info('autoinstallation job is success')
-                    ip = msg['data'].split(',')[1]
-                    return ip
-                elif msg['data'] == 'fail':
-                    log.info('autoinstallation job is fail')
-                    return False
+    journal = attr.ib(default=None)
+    # None runs the test level in constants.json
+    test_level = attr.ib(default=None)
+    _ksins = attr.ib(default=None, init=False)
+    # timings and counters of this job only, for its final results
+    _metrics = attr.ib(default=attr.Factory(Metrics), init=False)
+    _coverage_ck = attr.ib(default=None, init=False)
+    # checkpoint runs read ahead of the final report
+    _checkpoint_runs = attr.ib(default=attr.Factory(dict), init=False)
+    # post-processing of checked kickstarts, overlapping the installations
+    _post = attr.ib(
+        default=attr.Factory(lambda: BackgroundTasks(POST_WORKERS)),
+        init=False)
 
     def _wait_for_cockpit(self, bkr_name):
-        pubsub_cockpit = self.rd_conn.pubsub()
-        pubsub_cockpit.subscribe("{0}-cockpit-result".format(bkr_name))
-        while True:
-            time.sleep(5)
-            msg = pubsub_cockpit.get_message(ignore_subscribe_messages=True)
-            log.info(msg)
-            if msg:
-                if msg['data']:
+        ch_name = "{0}-cockpit-result".format(bkr_name)
+        with ChannelWaiter(ch_name, self.rd_conn) as waiter:
+            while True:
+                data = waiter.next_message()
+                log.info(data)
+                if data:
                     log.info("cockpit test is done")
-                    return msg['data']
+                    return data
 
     def _provision(self, ks, m):
         bp = Beaker(
             srv_ip=CURRENT_IP_PORT[0], srv_port=CURRENT_IP_PORT[1], ks_file=ks)
-        bp.reserve(m)
+        # the host is reserved along with the others when the job starts
         ret = bp.reboot(m)
 
         log.info("reboot {} with return code {}".format(m, ret))
@@ -71,7 +79,7 @@ class JobRunner(object):
             kargs = ARGS_TPL.format(
                 srv_ip=CURRENT_IP_PORT[0],
                 srv_port=CURRENT_IP_PORT[1],
-                ks_file=ks,
+                ks_path=self.ksins.url_path(ks),
                 addition_params=addition_kernel_params)
             cb.add_new_system(
                 name=m,
@@ -89,114 +97,205 @@ class JobRunner(object):
 
     @property
     def ksins(self):
-        k = KickStartFiles()
-        # k.ks_filter = self.ks_filter
-        k.liveimg = self.build_url
-        return k
+        if self._ksins is None:
+            k = KickStartFiles(self.journal.job_id if self.journal else None)
+            # k.ks_filter = self.ks_filter
+            k.liveimg = self.build_url
+            self._ksins = k
+        return self._ksins
 
     @property
     def job_queue(self):
         return self.ksins.get_job_queue()
 
-    def go(self):
-        self._set_repos()
-        for m, ksl in self.job_queue.items():
-            for ks in ksl:
-                self.results_logs.get_actual_logger(ks)
-                log.info("start provisioning on host %s with %s", m, ks)
+    def _install(self, m, ks, n, step):
+        """Provision m with ks, or re-attach to the installation started
+        before a restart, and return the ip of the installed host"""
+        waiter = InstallationWaiter(m, self.rd_conn)
+        reattach = step.get('phase') == PROVISIONED
+        if reattach:
+            waiter.timeout = max(
+                INSTALL_TIMEOUT - (time.time() - step['updated']), 60)
+            log.info("installation of %s on host %s is running already, "
+                     "wait for it at most %ss", ks, m, int(waiter.timeout))
 
+        # subscribe before provisioning, the host can't report done earlier
+        with waiter:
+            if not reattach:
+                waiter.clear_done()
                 if self.debug:
                     log.debug("now is debug mode, will not do provisioning")
                     ret = 0
                 else:
-                    ret = self._provision(ks, m)
+                    with metrics.span('provision'):
+                        ret = self._provision(ks, m)
 
                 log.info(self.results_logs.current_log_path)
 
-                if ret == 0:
-                    log.info("provisioning on host %s finished " +
-                             "with kickstart file %s return code 0", m, ks)
-                    p = self.rd_conn.pubsub(ignore_subscribe_messages=True)
-                    log.info("subscribe channel %s", m)
-                    p.subscribe(m)
-                    log.info("start daemon thread to listen on channel %s", m)
-                    t = inst_watcher(m, p)
-                    t.setDaemon(True)
-                    t.start()
-                    t.join()
-
-                    ret = self._wait_for_installation(p)
-                    if not ret:
-                        log.info(
-                            "auto installation failed, contine to next job")
-                        continue
-                    else:
-                        log.info(
-                            "auto installation finished, contine to chekcpoints"
-                        )
-
-                        self.results_logs.logger_name = 'checkpoints'
-                        self.results_logs.get_actual_logger(ks)
-
-                        if ks.find("ati") == 0:
-                            self.test_flag = "install"
-                            ck = CheckInstall()
-                        elif ks.find("atu") == 0:
-                            self.test_flag = "upgrade"
-                            ck = CheckUpgrade()
-                            ck.source_build = self.build_url.split('/')[-2]
-                            ck.target_build = self.target_build
-                        elif ks.find("atv") == 0:
-                            self.test_flag = "vdsm"
-                            ck = CheckVdsm()
-                            ck.build = self.build_url.split('/')[-2]
-                        else:
-                            log.error(
-                                "ks file name %s isn't started with ati/atu/atv.",
-                                ks)
-                            continue
-
-                        log.info("ip is %s", ret)
-                        ck.host_string, ck.host_user, ck.host_pass = (ret,
-                                                                      'root',
-                                                                      'redhat')
-                        ck.beaker_name = m
-                        ck.ksfile = ks
-
-                        log.info(ck.go_check())
-
-                        if ks.find("ati") == 0 and COVERAGE_TEST:
-                            upload_coverage_raw_res_from_host(ck)
-
-                            # TODO wati for cockpit new results format
-                else:
+                if ret != 0:
                     log.error(
                         "provisioning on host %s failed with return code %s",
                         m, ret)
+                    return None
 
-        self.generate_final_results()
+                log.info("provisioning on host %s finished " +
+                         "with kickstart file %s return code 0", m, ks)
+                self.journal.record(m, ks, n, PROVISIONED)
+
+            with metrics.span('install_wait'):
+                return waiter.wait()
+
+    def _run_ks(self, m, ks, n):
+        """Run ks as the n-th kickstart of host m"""
+        step = self.journal.step(m, ks, n)
+        if step.get('phase') in DONE_PHASES:
+            log.info("%s on host %s is %s already, skip it", ks, m,
+                     step['phase'])
+            return
+
+        self.results_logs.logger_name = 'results'
+        self.results_logs.get_actual_logger(ks, m)
+        log.info("start provisioning on host %s with %s", m, ks)
+
+        if step.get('phase') == INSTALLED:
+            ret = step['ip']
+            log.info("%s is installed on host %s already", ks, m)
+        else:
+            ret = self._install(m, ks, n, step)
+
+        if not ret:
+            log.info("auto installation failed, contine to next job")
+            metrics.incr('installs/failed')
+            self.journal.record(m, ks, n, FAILED)
+            return
+        metrics.incr('installs/done')
+        self.journal.record(m, ks, n, INSTALLED, ip=ret)
+        log.info("auto installation finished, contine to chekcpoints")
+
+        self.results_logs.logger_name = 'checkpoints'
+        self.results_logs.get_actual_logger(ks, m)
+
+        if ks.find("ati") == 0:
+            ck = CheckInstall()
+        elif ks.find("atu") == 0:
+            ck = CheckUpgrade()
+            ck.source_build = self.build_url.split('/')[-2]
+            ck.target_build = self.target_build
+        elif ks.find("atv") == 0:
+            ck = CheckVdsm()
+            ck.build = self.build_url.split('/')[-2]
+        else:
+            log.error("ks file name %s isn't started with ati/atu/atv.", ks)
+            self.journal.record(m, ks, n, FAILED)
+            return
+
+        log.info("ip is %s", ret)
+        ck.host_string, ck.host_user, ck.host_pass = (ret, 'root', 'redhat')
+        ck.beaker_name = m
+        ck.ksfile = ks
+        ck.results_file = os.path.join(self.results_logs.current_log_path,
+                                       CK_RESULTS_FILE)
+
+        with metrics.span('checkpoints'):
+            cks = ck.go_check()
+            log.info(cks)
+        log.info("%s ssh handshakes to %s so far", ssh_pool.handshakes(ret),
+                 ret)
 
         if ks.find("ati") == 0 and COVERAGE_TEST:
-            generate_final_coverage_result(ck, self.build_url.split('/')[-2])
+            # only the download needs the host, the raw results of all
+            # hosts are gathered in one local directory in the background
+            cov_tar = os.path.join(COV_LOCAL_DEAL_PATH, '{}-{}.{}'.format(
+                m, ks, COV_RAW_RES_TAR_NAME))
+            with metrics.span('coverage_fetch'):
+                fetched = fetch_coverage_raw_res_from_host(ck, cov_tar)
+            if fetched:
+                self._post.submit(self._extract_coverage, cov_tar)
+            self._coverage_ck = ck
+
+            # TODO wati for cockpit new results format
+
+        self.journal.record(m, ks, n, CHECKED, results=cks)
+        self._post.submit(ResultsToPolarion.read_checkpoint_runs,
+                          self.results_logs.current_log_file,
+                          self._checkpoint_runs)
+
+    @staticmethod
+    def _extract_coverage(cov_tar):
+        with metrics.span('coverage_extract'):
+            extract_coverage_raw_res(cov_tar)
+
+    def _run_host_queue(self, host_queue):
+        m, ksl = host_queue
+        # kickstarts in KS_PRESSURE_MAP are in the queue several times
+        for n, ks in enumerate(ksl):
+            self._run_ks(m, ks, n)
+
+    def go(self):
+        set_thread_test_level(self.test_level)
+        set_current_results_logs(self.results_logs)
+        self.results_logs.start_job_log()
+        set_thread_metrics(self._metrics)
+        if self.journal is None:
+            date, time_ = self.results_logs.log_stamp
+            self.journal = JobJournal.create(
+                self.rd_conn,
+                img_url=self.build_url,
+                target_build=self.target_build or '',
+                log_date=date,
+                log_time=time_,
+                test_level=self.test_level or '')
+        self._set_repos()
+
+        # every host works through its own kickstarts, the results can only
+        # be summarized after all of them are done
+        job_queue = self.job_queue
+        if not self.debug:
+            with metrics.span('reserve'):
+                failed = Beaker().reserve_all(job_queue)
+            if failed:
+                log.warning("reserving %s failed, they may be reserved "
+                            "already", ', '.join(failed))
+        # the report is filed with the flag of the last kickstart in the
+        # queue, as when the hosts ran one after another
+        for ksl in job_queue.values():
+            for ks in ksl:
+                self.test_flag = TEST_FLAGS.get(ks[:3], self.test_flag)
+        log.info("run kickstarts on %s hosts, at most %s at the same time",
+                 len(job_queue), MAX_PARALLEL_HOSTS)
+        run_concurrently(self._run_host_queue, job_queue.items(),
+                         MAX_PARALLEL_HOSTS)
+        with metrics.span('post_wait'):
+            self._post.join()
+
+        self.generate_final_results()
+        self.journal.finish()
+        self.ksins.release()
+
+        if self._coverage_ck and COVERAGE_TEST:
+            generate_final_coverage_result(self._coverage_ck,
+                                           self.build_url.split('/')[-2])
 
         cache_logs_summary()
-        self.rd_conn.set("running", "0")
 
     def generate_final_results(self):
         try:
-            log_path = self.results_logs.current_log_path
-            build_name = self.results_logs.parse_img_url()
-            if build_name not in log_path:
+            final_path = self.results_logs.build_log_path
+            if not os.path.isdir(final_path):
+                # no kickstart ran
                 return
-            final_path = os.path.join(
-                log_path.split(build_name)[0], build_name)
             report = ResultsToPolarion(final_path, '-l', self.test_flag,
                                        self.target_build)
-            report.run()
+            report.metrics = self._metrics.snapshot()
+            report.checkpoint_runs = self._checkpoint_runs
+            with metrics.span('report'):
+                report.run()
         except Exception as e:
             log.error(e)
 
 
-def job_runner(img_url, rd_conn, results_logs, target_build=None):
-    ins = JobRunner(img_url, rd_conn, results_logs, target_build)
+def job_runner(img_url, rd_conn, results_logs, target_build=None,
+               journal=None, test_level=None):
+    ins = JobRunner(img_url, rd_conn, results_logs, target_build,
+                    journal=journal, test_level=test_level)
     return Thread(target=ins.go)
@@ -0,0 +1,113 @@
+"""Progress of a job kept in redis, so a restarted server can resume it
+
+Every step of a job, a ks run on a machine, goes through the phases
+below; the journal keeps the last phase of each step along with what it
+produced, like the ip of the installed host or the checkpoint results.
+A ks may run several times on the same machine, its steps are told apart
+by their index in the queue of the machine.
+"""
+import json
+import time
+import uuid
+import logging
+import attr
+
+from .utils import init_redis
+
+log = logging.getLogger('bender')
+
+PROVISIONED = 'provisioned'
+INSTALLED = 'installed'
+CHECKED = 'checked'
+REPORTED = 'reported'
+FAILED = 'failed'
+# steps in these phases are not run again when the job is resumed
+DONE_PHASES = (CHECKED, REPORTED)
+
+JOB_KEY_TPL = 'job:{}'
+# ids of the jobs started and not finished yet
+ACTIVE_JOBS_KEY = 'job:active'
+
+
+@attr.s
+class JobJournal(object):
+    job_id = attr.ib()
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+
+    @property
+    def key(self):
+        return JOB_KEY_TPL.format(self.job_id)
+
+    @property
+    def steps_key(self):
+        return self.key + ':steps'
+
+    @classmethod
+    def create(cls, redis_conn, status='running', **info):
+        """Start the journal of a new job, described by info"""
+        journal = cls(uuid.uuid4().hex[:12], redis_conn)
+        info.update(status='queued', created=time.time())
+        redis_conn.hmset(journal.key, info)
+        log.info("start journal of job %s", journal.job_id)
+        if status == 'running':
+            journal.start()
+        return journal
+
+    @classmethod
+    def unfinished(cls, redis_conn):
+        """Journals of the started jobs which didn't finish, oldest first"""
+        journals = [
+            cls(job_id, redis_conn)
+            for job_id in redis_conn.smembers(ACTIVE_JOBS_KEY)
+        ]
+        infos = dict((j.job_id, j.info) for j in journals)
+        journals = [
+            j for j in journals if infos[j.job_id].get('status') == 'running'
+        ]
+        return sorted(journals, key=lambda j: float(infos[j.job_id]['created']))
+
+    @property
+    def info(self):
+        return self.redis_conn.hgetall(self.key)
+
+    @staticmethod
+    def _field(m, ks, n):
+        return '{}|{}|{}'.format(m, ks, n)
+
+    def step(self, m, ks, n):
+        """Last recorded state of running ks on m as the n-th kickstart of
+        m, {} if not started"""
+        data = self.redis_conn.hget(self.steps_key, self._field(m, ks, n))
+        return json.loads(data) if data else {}
+
+    def steps(self):
+        """Recorded states by (m, ks, n)"""
+        steps = {}
+        for field, data in self.redis_conn.hgetall(self.steps_key).items():
+            m, ks, n = field.split('|')
+            steps[(m, ks, int(n))] = json.loads(data)
+        return steps
+
+    def record(self, m, ks, n, phase, **data):
+        step = self.step(m, ks, n)
+        step.update(data)
+        step.update(phase=phase, updated=time.time())
+        self.redis_conn.hset(self.steps_key, self._field(m, ks, n),
+                             json.dumps(step))
+        log.info("job %s: %s on %s is %s", self.job_id, ks, m, phase)
+
+    def start(self):
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(self.key, 'status', 'running')
+        pipe.sadd(ACTIVE_JOBS_KEY, self.job_id)
+        pipe.execute()
+
+    def finish(self):
+        """Mark the checked steps reported and the job done"""
+        for (m, ks, n), step in self.steps().items():
+            if step['phase'] == CHECKED:
+                self.record(m, ks, n, REPORTED)
+        pipe = self.redis_conn.pipeline()
+        pipe.hset(self.key, 'status', 'done')
+        pipe.srem(ACTIVE_JOBS_KEY, self.job_id)
+        pipe.execute()
@@ -3,23 +3,127 @@
 # pylint: disable=C0103, W0403
 
 import os
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 
 from pykickstart.parser import Script
 from pykickstart.constants import KS_SCRIPT_PRE, KS_SCRIPT_POST
 
 from constants import KS_FILES_DIR, KS_FILES_AUTO_DIR, \
-    HOSTS, POST_SCRIPT_01, POST_SCRIPT_02, PRE_SCRIPT_01, PRE_SCRIPT_02, TEST_LEVEL
-from utils import get_machine_ksl_map, get_ks_machine_map
+    HOSTS, POST_SCRIPT_01, POST_SCRIPT_02, PRE_SCRIPT_01, PRE_SCRIPT_02, \
+    PRE_SCRIPT_ANAMON
+from utils import get_machine_ksl_map, get_ks_machine_map, get_current_test_level, \
+    write_atomically
 
 loger = logging.getLogger('bender')
 
+# source kickstart path -> (mtime, lines)
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+class KickStartStore(object):
+    """Rendered kickstarts kept in memory, addressed by their sha1
+
+    The latest content of every kickstart name is always kept, so are the
+    contents pinned by a job until it releases them. Other contents are
+    dropped, oldest first, beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._contents = OrderedDict()
+        self._hashes = {}
+        # job id -> {ks: hash} of the contents the job provisions hosts with
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def put(self, ks, content, job_id=None):
+        """Keep content of ks, pinned for job_id if given, return its hash"""
+        ks_hash = hashlib.sha1(content).hexdigest()
+        with self._lock:
+            self._contents.pop(ks_hash, None)
+            self._contents[ks_hash] = content
+            self._hashes[ks] = ks_hash
+            if job_id is not None:
+                self._pins.setdefault(job_id, {})[ks] = ks_hash
+            self._evict()
+        return ks_hash
+
+    def release(self, job_id):
+        """Unpin the contents of job_id, they may be dropped from now on"""
+        with self._lock:
+            self._pins.pop(job_id, None)
+            self._evict()
+
+    def _evict(self):
+        kept = set(self._hashes.values())
+        for pinned in self._pins.values():
+            kept.update(pinned.values())
+        for ks_hash in list(self._contents):
+            if len(self._contents) <= self.max_entries:
+                break
+            if ks_hash not in kept:
+                del self._contents[ks_hash]
+
+    def pinned_names(self):
+        """Names of the kickstarts pinned by any job"""
+        with self._lock:
+            return set(ks for pinned in self._pins.values() for ks in pinned)
+
+    def get(self, ks_hash):
+        return self._contents.get(ks_hash)
+
+    def hash_of(self, ks):
+        return self._hashes.get(ks)
+
+    def url_path(self, ks):
+        """Path the kickstart is served at, from disk if not in memory"""
+        ks_hash = self.hash_of(ks)
+        if ks_hash is None:
+            return '/static/auto/{}'.format(ks)
+        return '/ks/{}'.format(ks_hash)
+
+
+ks_store = KickStartStore()
+
+
+def _load_template(ks_path):
+    """Lines of a source kickstart, read again only once it's modified"""
+    mtime = os.path.getmtime(ks_path)
+    with _templates_lock:
+        cached = _templates.get(ks_path)
+        if cached is None or cached[0] != mtime:
+            with open(ks_path) as fp:
+                cached = (mtime, fp.readlines())
+            _templates[ks_path] = cached
+    return cached[1]
+
+
+def _write_if_changed(path, content):
+    """Atomically replace path with content, unless it holds it already"""
+    if os.path.exists(path):
+        with open(path) as fp:
+            if fp.read() == content:
+                return False
+
+    write_atomically(path, content)
+    return True
+
 
 class KickStartFiles(object):
     """"""
 
-    def __init__(self):
+    def __init__(self, job_id=None):
         self._liveimg = None
+        # the rendered contents are pinned in ks_store for job_id until it
+        # calls release()
+        self.job_id = job_id
+        # ks -> hash of the contents rendered for this job, other jobs may
+        # render the same ks for another build at the same time
+        self._hashes = {}
 
     @property
     def liveimg(self):
@@ -54,45 +158,74 @@ class KickStartFiles(object):
             sp.lineno = lineno
         return sp
 
-    def _convert_to_auto_ks(self):
-        loger.info("remove all old files under {}".format(KS_FILES_AUTO_DIR))
-        os.system("rm -f {}/*".format(KS_FILES_AUTO_DIR))
-
-        ks_machine_map = get_ks_machine_map()
-
-        for ks in ks_machine_map:
-
-            bkr_name = ks_machine_map.get(ks)
+    def _render(self, ks, bkr_name):
+        nic_name = HOSTS.get(bkr_name).get("nic").keys()[0].split('-')[-1]
+        new_live_img = "liveimg --url=" + self._liveimg + "\n"
 
-            nic_name = HOSTS.get(bkr_name).get("nic").keys()[0].split('-')[-1]
+        lines = [
+            new_live_img if "liveimg --url=" in line else line
+            for line in _load_template(os.path.join(KS_FILES_DIR, ks))
+        ]
 
-            ks_ = os.path.join(KS_FILES_DIR, ks)
-            ks_out = os.path.join(KS_FILES_AUTO_DIR, ks)
+        if 'atv_bonda' not in ks:
+            post_script = self._generate_ks_script(
+                POST_SCRIPT_01.format(nic_name) + bkr_name,
+                error_on_fail=False)
+        else:
+            post_script = self._generate_ks_script(
+                POST_SCRIPT_02 + bkr_name, error_on_fail=False)
 
-            new_live_img = "liveimg --url=" + self._liveimg
+        pre_script = self._generate_ks_script(
+            PRE_SCRIPT_01 + PRE_SCRIPT_ANAMON + bkr_name + '\n' +
+            PRE_SCRIPT_02,
+            script_type=KS_SCRIPT_PRE,
+            error_on_fail=False)
 
-            os.system("sed '/liveimg --url=/ c\{}' {} > {}".format(
-                new_live_img, ks_, ks_out))
+        content = ''.join(lines)
+        if not content.endswith('\n'):
+            content += '\n'
+        return content + pre_script.__str__() + post_script.__str__()
 
-            if 'atv_bonda' not in ks:
-                post_script = self._generate_ks_script(
-                    POST_SCRIPT_01.format(nic_name) + bkr_name,
-                    error_on_fail=False)
-            else:
-                post_script = self._generate_ks_script(
-                    POST_SCRIPT_02 + bkr_name, error_on_fail=False)
+    def _convert_to_auto_ks(self):
+        if not os.path.exists(KS_FILES_AUTO_DIR):
+            os.makedirs(KS_FILES_AUTO_DIR)
 
-            pre_script = self._generate_ks_script(
-                PRE_SCRIPT_01 + PRE_SCRIPT_02,
-                script_type=KS_SCRIPT_PRE,
-                error_on_fail=False)
+        ks_machine_map = get_ks_machine_map()
 
-            with open(ks_out, "a") as fp:
-                fp.write(pre_script.__str__())
-                fp.write(post_script.__str__())
+        rewritten = 0
+        for ks in ks_machine_map:
+            bkr_name = ks_machine_map.get(ks)
+            ks_out = os.path.join(KS_FILES_AUTO_DIR, ks)
+            content = self._render(ks, bkr_name)
+            self._hashes[ks] = ks_store.put(ks, content, self.job_id)
+            # the copy on disk is kept for browsing and older clients
+            if _write_if_changed(ks_out, content):
+                rewritten += 1
+        loger.info("{} of {} kickstarts rewritten under {}".format(
+            rewritten, len(ks_machine_map), KS_FILES_AUTO_DIR))
+
+        # other jobs running meanwhile may still point hosts at their files
+        live = ks_store.pinned_names() | set(ks_machine_map)
+        for f in os.listdir(KS_FILES_AUTO_DIR):
+            stale = os.path.join(KS_FILES_AUTO_DIR, f)
+            if f not in live and os.path.isfile(stale):
+                loger.info("remove old file {}".format(f))
+                os.remove(stale)
+
+    def url_path(self, ks):
+        """Path ks is served at, as rendered by this instance"""
+        ks_hash = self._hashes.get(ks)
+        if ks_hash is None or ks_store.get(ks_hash) is None:
+            raise KeyError("{} isn't rendered for this job".format(ks))
+        return '/ks/{}'.format(ks_hash)
+
+    def release(self):
+        """Let ks_store drop the contents rendered for this job"""
+        if self.job_id is not None:
+            ks_store.release(self.job_id)
 
     def get_job_queue(self):
-        print "current test level is %x" % TEST_LEVEL
+        print "current test level is %x" % get_current_test_level()
         self._convert_to_auto_ks()
 
         return get_machine_ksl_map()
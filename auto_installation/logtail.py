@@ -0,0 +1,143 @@
+"""Last lines of the current log, kept in memory for the dashboard
+
+A thread follows the log file of the current job and appends its new
+lines to a ring buffer, so polls of the dashboard don't touch the file at
+all. It's woken by inotify when pyinotify is there, else it checks the
+size of the file every `interval` seconds.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+log = logging.getLogger('bender')
+
+# how much of the end of a file is read for its last lines
+_TAIL_BYTES = 64 * 1024
+
+
+class _InotifyWaiter(object):
+    """Wait for a file to be modified"""
+
+    def __init__(self):
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._wm, lambda event: None)
+        self._path = None
+        self._wds = {}
+
+    def wait(self, path, timeout):
+        if path != self._path:
+            if self._wds:
+                self._wm.rm_watch(self._wds.values())
+            # the file may be replaced, watch its directory for that
+            self._wds = self._wm.add_watch(
+                os.path.dirname(path),
+                pyinotify.IN_MODIFY | pyinotify.IN_CREATE |
+                pyinotify.IN_MOVED_TO)
+            self._path = path
+        if self._notifier.check_events(timeout * 1000):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+
+class LogTail(object):
+    """Ring buffer of the last `maxlen` lines of the file get_path()
+    returns, which may change over time
+
+    Every line appended gets the next sequence number, followers pass the
+    last one they got to `since` for the newer lines.
+    """
+
+    def __init__(self, get_path, maxlen=500, interval=1):
+        self.get_path = get_path
+        self.interval = interval
+        self._lines = deque(maxlen=maxlen)
+        self._seq = 0
+        self._path = None
+        self._stat = None
+        self._pos = 0
+        self._partial = ''
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _loop(self):
+        waiter = _InotifyWaiter() if pyinotify else None
+        while True:
+            try:
+                self.refresh()
+                if waiter and self._path and os.path.exists(self._path):
+                    waiter.wait(self._path, self.interval)
+                    continue
+            except Exception as e:
+                log.exception(e)
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """Append the lines written since the last refresh"""
+        path = self.get_path()
+        if not path:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        with self._lock:
+            reset = path != self._path or st.st_ino != self._stat.st_ino or \
+                st.st_size < self._pos
+            if reset:
+                # another file, or this one was truncated
+                self._path, self._partial = path, ''
+                self._lines.clear()
+                start = max(st.st_size - _TAIL_BYTES, 0)
+            elif st.st_size == self._pos:
+                return
+            else:
+                start = self._pos
+            self._stat = st
+
+            with open(path) as fp:
+                fp.seek(start)
+                data = fp.read()
+            self._pos = start + len(data)
+
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            if reset and start:
+                # read from the middle of the first line
+                lines = lines[1:]
+            for line in lines:
+                self._lines.append(line.decode('utf-8', 'replace') + u'\n')
+                self._seq += 1
+
+    def lines(self, n=1):
+        """The last n complete lines, oldest first"""
+        with self._lock:
+            n = min(n, len(self._lines))
+            return list(self._lines)[len(self._lines) - n:]
+
+    def since(self, seq):
+        """(lines appended after seq, seq of the last one)"""
+        with self._lock:
+            n = min(self._seq - seq, len(self._lines))
+            if n <= 0:
+                return [], self._seq
+            return list(self._lines)[len(self._lines) - n:], self._seq
+
+    @property
+    def seq(self):
+        with self._lock:
+            return self._seq
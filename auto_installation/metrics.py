@@ -0,0 +1,105 @@
+"""Timings and counters of the running jobs
+
+They're reset when a job starts while no other one is running. A thread
+working for a job also records into the metrics of that job, which go
+into its final results.
+
+Spans are aggregated by name, e.g. every `checkpoint/iqn_check` of a job
+adds to the same count, total, min and max.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+# metrics of the job a thread works for
+_thread_metrics = threading.local()
+
+
+def set_thread_metrics(job_metrics):
+    _thread_metrics.metrics = job_metrics
+
+
+def get_thread_metrics():
+    return getattr(_thread_metrics, 'metrics', None)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            # name -> [count, total, min, max]
+            self._spans = {}
+            self._counters = {}
+
+    def _job_metrics(self):
+        job_metrics = get_thread_metrics()
+        return job_metrics if job_metrics is not self else None
+
+    def record(self, name, seconds):
+        job_metrics = self._job_metrics()
+        if job_metrics is not None:
+            job_metrics.record(name, seconds)
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                self._spans[name] = [1, seconds, seconds, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                span[2] = min(span[2], seconds)
+                span[3] = max(span[3], seconds)
+
+    def incr(self, name, n=1):
+        job_metrics = self._job_metrics()
+        if job_metrics is not None:
+            job_metrics.incr(name, n)
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def snapshot(self):
+        with self._lock:
+            spans = dict(
+                (name, dict(
+                    count=count,
+                    total=round(total, 3),
+                    min=round(min_, 3),
+                    max=round(max_, 3),
+                    avg=round(total / count, 3)))
+                for name, (count, total, min_, max_) in self._spans.items())
+            return dict(
+                started=self.started,
+                elapsed=round(time.time() - self.started, 3),
+                spans=spans,
+                counters=dict(self._counters))
+
+
+metrics = Metrics()
+
+
+def timed(name):
+    """Record every call of the decorated function as a span"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,10 +1,19 @@
+import re
 import attr
+import threading
 from pymongo import MongoClient
 from urllib import quote_plus
 
 
 @attr.s
 class MongoQuery(object):
+    """Queries of the meteor database
+
+    One MongoClient, with its connection pool, is shared per uri.
+    """
+    _clients = {}
+    _clients_lock = threading.Lock()
+
     user = attr.ib(default='meteor')
     password = attr.ib(default='redhat')
     host = attr.ib(default='10.66.10.22:27017/meteordb')
@@ -15,9 +24,16 @@ class MongoQuery(object):
         return "mongodb://%s:%s@%s" % (quote_plus(self.user),
                                        quote_plus(self.password), self.host)
 
+    @property
+    def client(self):
+        with self._clients_lock:
+            if self.uri not in self._clients:
+                self._clients[self.uri] = MongoClient(self.uri)
+            return self._clients[self.uri]
+
     @property
     def db(self):
-        return MongoClient(self.uri)[self.db_name]
+        return self.client[self.db_name]
 
     def collection(self, name):
         return self.db[name]
@@ -25,26 +41,26 @@ class MongoQuery(object):
     def rhvh_build_names(self, q='4.1'):
         c = self.collection('resources.rhevh36ngn')
         query = 'redhat-virtualization-host-{}'.format(q)
+        # an anchored regex is a prefix match, which can use an index
         return [
-            i['build_name'] for i in c.find()
-            if i['build_name'].startswith(query)
+            i['build_name'] for i in c.find(
+                {'build_name': {'$regex': '^' + re.escape(query)}},
+                projection=['build_name'])
         ]
 
     def machines(self, q=''):
+        """[auto, manual] hostnames, auto ones are commented 'zoidberg'"""
         c = self.collection('machines')
-        # for i in c.find(projection=['basic.ids.hostname', 'comments']):
-        #     print i.get('comments', [''])
-        auto = [
-            i['basic']['ids']['hostname']
-            for i in c.find(projection=['basic.ids.hostname', 'comments'])
-            if i['basic']['ids'] and i.get('comments', [''])[0] == 'zoidberg'
-        ]
-        manual = [
-            i['basic']['ids']['hostname']
-            for i in c.find(projection=['basic.ids.hostname', 'comments'])
-            if i['basic']['ids'] and i.get('comments', [''])[0] != 'zoidberg'
-        ]
-        return [auto, manual]
+        ret = c.aggregate([
+            {'$match': {'basic.ids.hostname': {'$exists': True}}},
+            {'$project': {
+                'hostname': '$basic.ids.hostname',
+                'auto': {'$eq': [{'$arrayElemAt': ['$comments', 0]},
+                                 'zoidberg']}}},
+            {'$group': {'_id': '$auto', 'hosts': {'$push': '$hostname'}}}
+        ])
+        hosts = dict((i['_id'], i['hosts']) for i in ret)
+        return [hosts.get(True, []), hosts.get(False, [])]
 
 
 if __name__ == '__main__':
@@ -6,11 +6,11 @@ try:
     from pylarion.test_run import TestRun
 except ImportError:
     print("pylarion must be installed")
-from constants import TR_ID, TR_PROJECT_ID, TR_TPL, LOG_URL
+from constants import TR_ID, TR_PROJECT_ID, TR_TPL, LOG_URL, CK_RESULTS_FILE
 from const_install import KS_PRESSURE_MAP
 import re
 import json
-from utils import get_testcase_map
+from utils import get_testcase_map, json_files, write_atomically
 from collections import OrderedDict
 
 import ssl
@@ -23,6 +23,110 @@ def make_test_run():
         test_run_id='4_0_Node_0622_AutoInstallWithKickstart_Must')
 
 
+class BulkExporter(object):
+    """Add test records to a test run in batches, each in one transaction
+
+    The batch size and the pause between batches follow the server: slow
+    commits shrink the batches and lengthen the pause, fast ones do the
+    opposite, and failed ones are retried after backing off. Keys of the
+    committed records are saved with the test run id in `checkpoint_file`,
+    so an interrupted export resumes with the same test run after the last
+    committed batch.
+    """
+    min_batch = 1
+    max_batch = 50
+    max_retries = 5
+    max_delay = 60
+    # seconds per record above which the server is considered loaded
+    slow_record_secs = 1.0
+
+    def __init__(self, export_record, checkpoint_file, batch_size=10):
+        self.export_record = export_record
+        self.checkpoint_file = checkpoint_file
+        self.batch_size = batch_size
+        self.delay = 0
+        self.checkpoint = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as fp:
+                return json.load(fp)
+        return dict(test_run_id=None, committed=[], done=False)
+
+    def save_checkpoint(self):
+        write_atomically(self.checkpoint_file,
+                         json.dumps(self.checkpoint, indent=4))
+
+    @property
+    def test_run_id(self):
+        return self.checkpoint['test_run_id']
+
+    @test_run_id.setter
+    def test_run_id(self, val):
+        self.checkpoint['test_run_id'] = val
+        self.save_checkpoint()
+
+    def _commit(self, tr, batch):
+        tr.session.tx_begin()
+        try:
+            for _, test_case_id, test_result in batch:
+                self.export_record(tr, test_case_id, test_result)
+        except Exception:
+            tr.session.tx_rollback()
+            raise
+        tr.session.tx_commit()
+
+    def _adapt(self, elapsed, size):
+        if elapsed / size > self.slow_record_secs:
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            self.delay = min(max(self.delay * 2, 1), self.max_delay)
+        else:
+            self.batch_size = min(self.max_batch, self.batch_size * 2)
+            self.delay = self.delay / 2.0 if self.delay > 0.1 else 0
+
+    def run(self, tr, records):
+        """Export [(key, test_case_id, test_result), ...] not committed yet
+
+        The key identifies a record in the checkpoint, one test case can be
+        checked by several kickstarts.
+        """
+        committed = set(self.checkpoint['committed'])
+        pending = [r for r in records if r[0] not in committed]
+        if committed:
+            print "Resume {} after {} committed records".format(
+                tr.test_run_id, len(committed))
+
+        tries = 0
+        while pending:
+            batch = pending[:self.batch_size]
+            start = time.time()
+            try:
+                self._commit(tr, batch)
+            except Exception as e:
+                tries += 1
+                if tries > self.max_retries:
+                    raise
+                self.batch_size = max(self.min_batch, self.batch_size // 2)
+                self.delay = min(max(self.delay * 2, 1), self.max_delay)
+                print "Commit failed: {}, retry in {}s".format(e, self.delay)
+                time.sleep(self.delay)
+                continue
+            tries = 0
+
+            self.checkpoint['committed'].extend(r[0] for r in batch)
+            self.save_checkpoint()
+            pending = pending[len(batch):]
+            print "Committed {} records, {} left".format(
+                len(batch), len(pending))
+
+            self._adapt(time.time() - start, len(batch))
+            if pending and self.delay:
+                time.sleep(self.delay)
+
+        self.checkpoint['done'] = True
+        self.save_checkpoint()
+
+
 class ResultsToPolarion(object):
     """
     /home/dracher/Zoidberg/logs/2017-03-08/redhat-virtualization-host-4.1-20170208.0
@@ -35,6 +139,13 @@ class ResultsToPolarion(object):
         self.target_build = target_build
         self.test_flag = test_flag
         self.jfilename = "final_results.json"
+        self.checkpoint_filename = "polarion_export.json"
+        self.final_results = None
+        # timings of the job, saved with the results when set
+        self.metrics = None
+        # checkpoints log -> (stamp of the file the runs were read from,
+        # runs), read by the job while the host installs its next kickstart
+        self.checkpoint_runs = {}
 
     @staticmethod
     def get_current_date():
@@ -78,13 +189,25 @@ class ResultsToPolarion(object):
             # TODO deal with blocked
             pass
 
-    def _parse_checkpoints(self, res):
-        ks = res.split('/')[-2]
-        if ks in KS_PRESSURE_MAP:
-            num = int(KS_PRESSURE_MAP[ks])
-        else:
-            num = 1
+    @staticmethod
+    def _read_checkpoint_runs(jfile):
+        """Results and iqns of the checkpoint runs recorded in jfile"""
+        runs = OrderedDict()
+        for line in open(jfile):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            run = runs.setdefault(record['run_id'], [{}, None])
+            run[0].update(record['cases'])
+            if record.get('iqn'):
+                run[1] = record['iqn']
+        # like in the log, a run without any case result doesn't count
+        runs = [run for run in runs.values() if run[0]]
+        return [ret for ret, _ in runs], [iqn for _, iqn in runs if iqn]
 
+    @staticmethod
+    def _scan_checkpoints_log(res):
+        """Results and iqns logged in the checkpoints log, for older runs"""
         p1 = re.compile(r"{'RHEVM-\d")
         p2 = re.compile(r'InitiatorName=iqn')
         rets = []
@@ -95,6 +218,50 @@ class ResultsToPolarion(object):
                     rets.append(eval(line.split("::")[-1]))
                 if p2.search(line):
                     iqns.append(line.split(":")[-1].rstrip("')\n"))
+        return rets, iqns
+
+    @staticmethod
+    def _runs_stamp(res):
+        jfile = os.path.join(os.path.dirname(res), CK_RESULTS_FILE)
+        src = jfile if os.path.exists(jfile) else res
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None
+        return src, st.st_mtime, st.st_size
+
+    @classmethod
+    def read_checkpoint_runs(cls, res, checkpoint_runs):
+        """Read the runs of the kickstart logging into res ahead of the
+        report into the checkpoint_runs of the job, the report takes them as
+        long as the file isn't changed"""
+        stamp = cls._runs_stamp(res)
+        if stamp is None:
+            return
+        if stamp[0] == res:
+            runs = cls._scan_checkpoints_log(res)
+        else:
+            runs = cls._read_checkpoint_runs(stamp[0])
+        checkpoint_runs[res] = (stamp, runs)
+
+    def _checkpoint_runs(self, res):
+        cached = self.checkpoint_runs.pop(res, None)
+        if cached and cached[0] == self._runs_stamp(res):
+            return cached[1]
+
+        jfile = os.path.join(os.path.dirname(res), CK_RESULTS_FILE)
+        if os.path.exists(jfile):
+            return self._read_checkpoint_runs(jfile)
+        return self._scan_checkpoints_log(res)
+
+    def _parse_checkpoints(self, res):
+        ks = res.split('/')[-2]
+        if ks in KS_PRESSURE_MAP:
+            num = int(KS_PRESSURE_MAP[ks])
+        else:
+            num = 1
+
+        rets, iqns = self._checkpoint_runs(res)
 
         retNum = len(rets)
         if retNum != num:
@@ -167,14 +334,15 @@ class ResultsToPolarion(object):
         final_results['sum']['errorlist'] = list(
             set(need_run_cases) - set(actual_run_cases))
 
+        if self.metrics:
+            final_results['metrics'] = self.metrics
+
         final_results_jfile = os.path.join(root_path,
                                            self.jfilename)
+        self.final_results = final_results
         try:
-            with open(final_results_jfile, 'w') as json_file:
-                json_file.write(
-                    json.dumps(
-                        final_results, indent=4))
-
+            # the api serves it while it's written
+            json_files.dump(final_results_jfile, final_results, indent=4)
             return final_results_jfile
         except Exception as e:
             print e
@@ -187,7 +355,7 @@ class ResultsToPolarion(object):
 
         print "Begin to transport results to polarion..."
 
-        final_results = json.load(open(jfile))
+        final_results = self.final_results or json.load(open(jfile))
         ks_list = []
         for ks in final_results.get(self.source_build):
             ks_list.append(ks.encode())
@@ -195,21 +363,33 @@ class ResultsToPolarion(object):
 
         title = final_results.get("sum").get("title")
 
-        tr = self.create_testrun(title)
-        tr.group_id = self.source_build
-        tr.description = '{} with {}'.format(title, ks_list)
-        tr.status = 'finished'
-        tr.update()
+        exporter = BulkExporter(
+            self.export_to_polarion,
+            os.path.join(os.path.dirname(jfile), self.checkpoint_filename))
+        if exporter.checkpoint['done']:
+            print "Results already transported to {}, remove {} to do it " \
+                "again".format(exporter.test_run_id, exporter.checkpoint_file)
+            return
+
+        if exporter.test_run_id:
+            tr = TestRun(project_id=TR_PROJECT_ID,
+                         test_run_id=exporter.test_run_id)
+        else:
+            tr = self.create_testrun(title)
+            tr.group_id = self.source_build
+            tr.description = '{} with {}'.format(title, ks_list)
+            tr.status = 'finished'
+            tr.update()
+            exporter.test_run_id = tr.test_run_id
 
         print tr.uri
         print tr.test_run_id
 
-        rets = final_results.get(self.source_build).values()
-        for ret in rets:
-            for k, v in ret.items():
-                self.export_to_polarion(tr, k, v)
-                print "be nice with server, sleep 1 sec"
-                time.sleep(1)
+        records = []
+        for ks, ret in final_results.get(self.source_build).items():
+            records.extend(
+                ('{}/{}'.format(ks, k), k, v) for k, v in ret.items())
+        exporter.run(tr, records)
 
         print "Transport results to polarion finished."
 
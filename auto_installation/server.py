@@ -1,33 +1,64 @@
 from __future__ import unicode_literals
 # pylint: disable=W0403, C0103
 import os
-import base64
 import json
+import time
+import zlib
 import utils
 import subprocess as sp
 
 from flask import Flask, request, redirect, abort, jsonify
 from flask_cors import CORS
-
-from .utils import init_redis, setup_funcs, get_lastline_of_file
-from .util_result_index import cache_logs_summary
-from .constants import CURRENT_IP_PORT, BUILDS_SERVER_URL, CB_PROFILE, HOSTS, TEST_LEVEL, PROJECT_ROOT
-from .jobs import job_runner
+try:
+    # streams mustn't block the other requests of the gevent server
+    from gevent import sleep
+except ImportError:
+    from time import sleep
+
+from .utils import init_redis, setup_funcs, get_current_test_level, TTLCache, \
+    json_files
+from .util_result_index import get_logs_summary
+from .constants import CURRENT_IP_PORT, BUILDS_SERVER_URL, CB_PROFILE, HOSTS, PROJECT_ROOT, \
+    PROFILE_DIR, INSTALL_DONE_KEY, INSTALL_TIMEOUT, cfgjson
+from .journal import JobJournal
+from .dispatch import dispatcher
+from .hoststatus import status_poller
 from .cobbler import Cobbler
+from .kickstarts import ks_store
 from .mongodata import MongoQuery
 from .celerytask import RhvhTask
 from .reports import ResultsToPolarion
+from .uploads import LogChunkWriter
+from .metrics import metrics
+from .logtail import LogTail
+from .events import event_hub
 
 rd_conn = init_redis()
 IP, PORT = CURRENT_IP_PORT
+COCKPIT_JSON = os.path.join(PROJECT_ROOT, 'auto_installation', 'static',
+                            'cockpit.json')
+TEST_SCEN_JSON = os.path.join(PROJECT_ROOT, 'auto_installation',
+                              'test_scen.json')
 # ensure singleton instance
 results_logs = utils.results_logs
 mongo = MongoQuery()
+rhvh_builds = TTLCache(mongo.rhvh_build_names, ttl=300)
+bkr_machines = TTLCache(mongo.machines, ttl=300)
 rt = RhvhTask()
+log_writer = LogChunkWriter()
+# the log of the job started last
+log_tail = LogTail(lambda: utils.current_results_logs().job_log_file)
 
 app = Flask(__name__)
 CORS(app, resources=r'/api/*')
 
+if PROFILE_DIR:
+    from werkzeug.contrib.profiler import ProfilerMiddleware
+    if not os.path.exists(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    app.wsgi_app = ProfilerMiddleware(
+        app.wsgi_app, profile_dir=PROFILE_DIR, restrictions=[30])
+
 
 @app.route('/post_result/<code>')
 def post_result(code):
@@ -45,34 +76,50 @@ def post_result(code):
 def start_job():
     """This method is the trigger function to start a automation test
 
+    The job is queued and starts once all the hosts of its test level are
+    free, jobs on disjoint hosts run at the same time.
+
     Args:
         img_url (str): /var/www/builds/rhevh/
         rhevh7-ng-36/rhev-hypervisor7-ng-3.6-20160518.0/
         rhev-hypervisor7-ng-3.6-20160518.0.x86_64.liveimg.squashfs
+        test_level (int): defaults to the one in constants.json
+        priority (int): higher ones are started first, defaults to 0
+        resume (bool): queue the unfinished jobs again, they continue from
+            their journals, the other args are ignored
 
     """
     if request.method == 'POST':
-        if rd_conn.get("running") == "0":
-            rd_conn.set("running", 1)
-            data = request.get_json()
-            img_url = data.get('img', None)
-            target_build = data.get('target_build', None)
-            if img_url:
-                _img_url = img_url.replace('/var/www/builds',
-                                           BUILDS_SERVER_URL)
-
-                results_logs.img_url = _img_url
-
-                t = job_runner(_img_url, rd_conn, results_logs, target_build)
-                t.setDaemon(True)
-                t.start()
-                return redirect('/post_result')
-        else:
-            return redirect('/goaway')
+        data = request.get_json()
+        if data.get('resume'):
+            return resume_job()
+        img_url = data.get('img', None)
+        target_build = data.get('target_build', None)
+        if img_url:
+            _img_url = img_url.replace('/var/www/builds', BUILDS_SERVER_URL)
+
+            dispatcher.start()
+            dispatcher.submit(_img_url, target_build,
+                              data.get('test_level'),
+                              data.get('priority', 0))
+            return redirect('/post_result')
     else:
         abort(406)
 
 
+def resume_job():
+    journals = JobJournal.unfinished(rd_conn)
+    # the jobs running already are left alone
+    resumed = [j for j in journals if dispatcher.requeue(j)]
+    if not resumed:
+        abort(404)
+
+    dispatcher.start()
+    for journal in resumed:
+        print("resume job {}".format(journal.job_id))
+    return redirect('/post_result')
+
+
 @app.route('/goaway', methods=['GET'])
 def goaway():
     return "automation test already running, please goaway"
@@ -82,6 +129,8 @@ def goaway():
 @app.route('/done/<em1ip>/<bkr_name>/<cockpit>')
 def done_job(em1ip, bkr_name, cockpit=None):
     """todo"""
+    rd_conn.set(INSTALL_DONE_KEY.format(bkr_name), 'done,{}'.format(em1ip),
+                ex=INSTALL_TIMEOUT)
     if cockpit is None:
         print("Remote node ip is {}".format(em1ip))
 
@@ -97,34 +146,44 @@ def done_job(em1ip, bkr_name, cockpit=None):
             em1ip, 'root', 'redhat'))
         print("prepare cockpit testing")
 
-        cockpit_cfg = os.path.join(PROJECT_ROOT, 'auto_installation', 'static',
-                                   'cockpit.json')
-        cockpit_cfg_ = None
-        with open(cockpit_cfg) as fp:
-            cockpit_cfg_ = json.load(fp)
-            cockpit_cfg_['host_ip'] = em1ip
-        with open(cockpit_cfg, 'w') as fp:
-            json.dump(cockpit_cfg_, fp)
+        json_files.update(COCKPIT_JSON, host_ip=em1ip)
         rt.lanuchCockpitAuto()
         return "cockpit done job"
 
 
-@app.route('/upload/<stage>/<log_name>/<offset>')
+@app.route('/upload/<stage>/<log_name>/<int:offset>', methods=['POST'])
 def upload_anaconda_log(stage, log_name, offset):
-    _data = request.get_json()
-    data = base64.decodestring(_data['data'])
-    log_file = os.path.join(results_logs.current_log_path, stage, log_name)
-    log_path = os.path.dirname(log_file)
+    """Write the raw, optionally gzipped, body into log_name at offset"""
+    log_path = utils.host_log_path(request.args.get('name'))
+    log_file = os.path.join(log_path, stage, log_name)
+    gzipped = request.headers.get('Content-Encoding') == 'gzip'
+
+    size = log_writer.write(log_file, offset, request.stream, gzipped)
+    return "upload done {}".format(size)
+
 
-    if not os.path.exists(log_path):
-        os.system("mkdir -p {}".format(log_path))
+@app.route('/upload/batch', methods=['POST'])
+def upload_anaconda_logs():
+    """Write the chunks of several logs sent in one body"""
+    log_path = utils.host_log_path(request.args.get('name'))
+    gzipped = request.headers.get('Content-Encoding') == 'gzip'
 
-    if offset != '-1':
-        with open(log_file, 'w') as fp:
-            fp.seek(int(offset))
-            fp.write(data)
-            fp.flush()
-    return "upload done"
+    try:
+        written = log_writer.write_batch(log_path, request.stream, gzipped)
+    except (ValueError, KeyError, IOError, zlib.error) as e:
+        abort(400, str(e))
+    return jsonify(written)
+
+
+@app.route('/ks/<ks_hash>')
+def get_kickstart(ks_hash):
+    """Serve a rendered kickstart from memory, it never changes"""
+    content = ks_store.get(ks_hash)
+    if content is None:
+        abort(404)
+    resp = app.response_class(content, mimetype='text/plain')
+    resp.set_etag(ks_hash)
+    return resp.make_conditional(request)
 
 
 # =========== api section =====================================================
@@ -135,20 +194,119 @@ def get_current_status():
     ret = {
         'cb_profile': CB_PROFILE,
         'running': rd_conn.get("running"),
-        'test_level': TEST_LEVEL,
+        'test_level': get_current_test_level(),
         'hosts': HOSTS
     }
     return jsonify(ret)
 
 
+@app.route('/api/v1/jobs')
+def get_jobs():
+    """Queued and running jobs, and the hosts leased to them"""
+    return jsonify(dispatcher.status())
+
+
+@app.route('/api/v1/hosts/status')
+def get_hosts_status():
+    """Beaker status of the hosts as last polled, null once expired
+
+    Optional arg: `host`, to get the status of that host only.
+    """
+    host = request.args.get('host')
+    if host is not None:
+        if host not in HOSTS:
+            abort(404)
+        return jsonify(status_poller.status(host))
+    return jsonify(status_poller.statuses())
+
+
 @app.route('/api/v1/current/build')
 def get_current_build():
-    build_path = results_logs.current_log_path
-    log_file = results_logs.current_log_file
-    ret = {'path': build_path, 'log': get_lastline_of_file(log_file)}
+    """Last line of the current log, and the last `lines` ones if asked"""
+    log_tail.start()
+    build_path = utils.current_results_logs().current_log_path
+    ret = {'path': build_path, 'log': ''.join(log_tail.lines(1))}
+    lines = request.args.get('lines', type=int)
+    if lines:
+        ret['lines'] = log_tail.lines(lines)
     return jsonify(ret)
 
 
+@app.route('/api/v1/current/build/stream')
+def stream_current_build():
+    """Server-Sent Events of the lines appended to the current log"""
+    log_tail.start()
+    seq = request.headers.get('Last-Event-ID', type=int)
+    if seq is None:
+        seq = log_tail.seq
+
+    def events(seq):
+        idle = 0
+        while True:
+            lines, seq = log_tail.since(seq)
+            if lines:
+                idle = 0
+                yield 'id: {}\n{}\n'.format(seq, ''.join(
+                    'data: {}\n'.format(line.rstrip('\n')) for line in lines))
+            else:
+                idle += 1
+                if idle % 15 == 0:
+                    # keeps proxies from closing it, and finds closed ones
+                    yield ':\n\n'
+            sleep(1)
+
+    resp = app.response_class(events(seq), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@app.route('/api/v1/events')
+def stream_events():
+    """Server-Sent Events of the job progress
+
+    Optional arg: `types`, comma separated event types to send, out of
+    install, cockpit, cockpit_result, checkpoint, job and host_status.
+    """
+    types = request.args.get('types')
+    types = set(types.split(',')) if types else None
+    event_hub.start()
+
+    def events():
+        # subscribed once sending starts, a client gone before is no leak
+        client = event_hub.subscribe()
+        last_sent = time.time()
+        try:
+            while True:
+                while client:
+                    event = client.popleft()
+                    if types is None or event['type'] in types:
+                        last_sent = time.time()
+                        yield 'event: {}\ndata: {}\n\n'.format(
+                            event['type'], json.dumps(event))
+                if time.time() - last_sent > 15:
+                    # keeps proxies from closing it, and finds closed ones
+                    last_sent = time.time()
+                    yield ':\n\n'
+                sleep(0.2)
+        finally:
+            event_hub.unsubscribe(client)
+
+    resp = app.response_class(events(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@app.route('/api/v1/metrics')
+def get_metrics():
+    """Timings and counters of the running, or last, jobs"""
+    return jsonify(metrics.snapshot())
+
+
+@app.route('/api/v1/upload/stats')
+def get_upload_stats():
+    return jsonify(log_writer.stats())
+
+
 @app.route('/api/v1/pxe/profiles')
 def get_pxe_profiles():
     with Cobbler() as cb:
@@ -157,12 +315,24 @@ def get_pxe_profiles():
 
 @app.route('/api/v1/rhvh_builds/<qname>')
 def get_rhvh_builds(qname):
-    return jsonify(mongo.rhvh_build_names(qname))
+    return jsonify(rhvh_builds.get(qname))
 
 
 @app.route('/api/v1/bkr_machines')
 def get_bkr_machines():
-    return jsonify(mongo.machines())
+    return jsonify(bkr_machines.get())
+
+
+def _launched(msg, task_id):
+    """Response to a launch, pointing at the status of its task"""
+    resp = jsonify(msg)
+    resp.headers['Location'] = '/api/v1/tasks/{}'.format(task_id)
+    return resp
+
+
+@app.route('/api/v1/tasks/<task_id>')
+def get_task_status(task_id):
+    return jsonify(rt.status(task_id))
 
 
 @app.route('/api/v1/autojob/lanuch', methods=['POST'])
@@ -174,27 +344,19 @@ def auto_job_lanuch():
         build = msg['build']
         target_build = msg['target_build']
 
-        cfg = os.path.join(PROJECT_ROOT, 'auto_installation', 'constants.json')
-        cfg_ = None
-
-        with open(cfg) as fp:
-            cfg_ = json.load(fp)
-            cfg_['cb_profile'] = pxe
-            cfg_['test_level'] = ts_level
-            cfg_['target_build'] = target_build
-        with open(cfg, 'w') as fp:
-            json.dump(cfg_, fp)
+        json_files.update(cfgjson, cb_profile=pxe, test_level=ts_level,
+                          target_build=target_build)
         # abort(401)
-        rt.lanuchAuto(build, pxe, ts_level, target_build)
-        return jsonify("job is launched")
+        task_id = rt.lanuchAuto(build, pxe, ts_level, target_build)
+        return _launched("job is launched", task_id)
 
 
 @app.route('/api/v1/upgradejob/lanuch', methods=['POST'])
 def upgrade_job_lanuch():
     if request.method == 'POST':
         msg = request.get_json()
-        rt.lanuchUpgrade(msg)
-        return jsonify("upgrade job is launched")
+        task_id = rt.lanuchUpgrade(msg)
+        return _launched("upgrade job is launched", task_id)
 
 
 @app.route('/api/v1/autojob/last_result')
@@ -209,22 +371,20 @@ def get_last_result():
             "total": -1
         }
     }
-    log_path = os.path.dirname(results_logs.current_log_path)
+    log_path = os.path.dirname(utils.current_results_logs().current_log_path)
     result_file = os.path.join(log_path, 'final_results.json')
 
-    if not os.path.exists(result_file):
+    try:
+        res = json_files.load(result_file)
+    except (OSError, IOError):
         return jsonify(ret_none)
-    else:
-        res = json.load(open(result_file))
-        res.update({'logpath': log_path})
-        return jsonify(res)
+    res.update({'logpath': log_path})
+    return jsonify(res)
 
 
 @app.route('/api/v1/cockpit/tslevel')
 def get_cockpit_tslevel():
-    cockpit_tslevle_fp = os.path.join(PROJECT_ROOT, 'auto_installation',
-                                      'test_scen.json')
-    return jsonify(json.load(open(cockpit_tslevle_fp)))
+    return jsonify(json_files.load(TEST_SCEN_JSON))
 
 
 @app.route('/api/v1/cockpit/lanuch', methods=['POST'])
@@ -237,30 +397,12 @@ def cockpit_job_lanuch():
         target_build = msg['target_build']
         test_profile = msg['cases']
 
-        cfg = os.path.join(PROJECT_ROOT, 'auto_installation', 'constants.json')
-        cfg_ = None
-
-        cockpit_cfg = os.path.join(PROJECT_ROOT, 'auto_installation', 'static',
-                                   'cockpit.json')
-        cockpit_cfg_ = None
-
-        with open(cfg) as fp:
-            cfg_ = json.load(fp)
-            cfg_['cb_profile'] = pxe
-            cfg_['test_level'] = ts_level
-            cfg_['target_build'] = target_build
-        with open(cfg, 'w') as fp:
-            json.dump(cfg_, fp)
-
-        with open(cockpit_cfg) as fp:
-            cockpit_cfg_ = json.load(fp)
-            cockpit_cfg_['test_profile'] = test_profile
-            cockpit_cfg_['host_ip'] = ""
-            cockpit_cfg_['test_build'] = build
-        with open(cockpit_cfg, 'w') as fp:
-            json.dump(cockpit_cfg_, fp)
-        rt.lanuchAuto(build, pxe, ts_level, target_build)
-        return jsonify("cockpit job is launched")
+        json_files.update(cfgjson, cb_profile=pxe, test_level=ts_level,
+                          target_build=target_build)
+        json_files.update(COCKPIT_JSON, test_profile=test_profile, host_ip="",
+                          test_build=build)
+        task_id = rt.lanuchAuto(build, pxe, ts_level, target_build)
+        return _launched("cockpit job is launched", task_id)
 
 
 @app.route('/api/v1/git/branch', methods=['GET'])
@@ -280,13 +422,25 @@ def git_branchs():
 
 @app.route('/api/v1/logs/summary', methods=['GET'])
 def logs_summary():
-    """_="""
-    res = rd_conn.get('logs_summary')
-    if not res:
-        print("no cache found, generate new cache")
-        cache_logs_summary()
-    res = json.loads(rd_conn.get('logs_summary'))
-    return jsonify(res)
+    """_=
+
+    Optional args: `from`/`to` dates (inclusive), `page` and `per_page`.
+    Without any of them the whole summary is returned as before.
+    """
+    args = request.args
+    date_from, date_to = args.get('from'), args.get('to')
+    page = args.get('page', type=int)
+    per_page = args.get('per_page', type=int)
+
+    summary, total = get_logs_summary(date_from, date_to, page, per_page)
+    if not any([date_from, date_to, page, per_page]):
+        return jsonify(summary)
+    return jsonify({
+        'summary': summary,
+        'total': total,
+        'page': page or 1,
+        'per_page': per_page or total
+    })
 
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+"""Pool of authenticated ssh connections to the hosts under test
+
+Every command runs on its own channel of the pooled connection, so the
+checkpoints of one host share a single handshake, and commands of different
+threads can run on the same connection at the same time.
+"""
+import os
+import pipes
+import socket
+import stat
+import threading
+import time
+import logging
+
+import paramiko
+from fabric.exceptions import NetworkError, CommandTimeout
+from metrics import metrics, timed
+
+log = logging.getLogger('bender')
+
+CONNECT_TIMEOUT = 10
+
+
+class CmdResult(str):
+    """Output of a remote command, like the string fabric's run returns"""
+
+    def __new__(cls, output, return_code):
+        ret = str.__new__(cls, output)
+        ret.return_code = return_code
+        return ret
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+class SSHSession(object):
+    """One authenticated connection to `user@host`
+
+    A connection which went away, e.g. while the host rebooted, is set up
+    again by the next command.
+    """
+    bufsize = 32768
+    poll_interval = 1
+
+    def __init__(self, host, user, password, port=22):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.handshakes = 0
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self):
+        transport = self._client.get_transport() if self._client else None
+        return transport is not None and transport.is_active()
+
+    @timed('ssh/handshake')
+    def _handshake(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(
+                self.host,
+                port=self.port,
+                username=self.user,
+                password=self.password,
+                timeout=CONNECT_TIMEOUT,
+                allow_agent=False,
+                look_for_keys=False)
+        except Exception:
+            client.close()
+            raise
+        finally:
+            self.handshakes += 1
+        return client
+
+    def connect(self, attempts=1):
+        with self._lock:
+            if self.connected:
+                return
+            self._close()
+
+            tries = 0
+            while True:
+                tries += 1
+                try:
+                    self._client = self._handshake()
+                    log.info("connected to %s@%s", self.user, self.host)
+                    return
+                except paramiko.AuthenticationException as e:
+                    raise NetworkError(
+                        "Authentication failed for {}@{}".format(
+                            self.user, self.host), e)
+                except (socket.error, paramiko.SSHException, EOFError) as e:
+                    if tries >= attempts:
+                        raise NetworkError(
+                            "Can't connect to {}@{} after {} attempts".format(
+                                self.user, self.host, tries), e)
+                    metrics.incr('ssh/connect_retries')
+                    # keep timeout-like pace while the host refuses us
+                    if not isinstance(e, socket.timeout):
+                        time.sleep(CONNECT_TIMEOUT)
+
+    def _close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _open_channel(self, attempts):
+        self.connect(attempts)
+        try:
+            return self._client.get_transport().open_session(
+                timeout=CONNECT_TIMEOUT)
+        except (socket.error, paramiko.SSHException, EOFError,
+                AttributeError):
+            # the connection died without the transport noticing yet
+            log.info("connection to %s is gone, reconnecting", self.host)
+            metrics.incr('ssh/reconnects')
+            self.close()
+            self.connect(attempts)
+            return self._client.get_transport().open_session(
+                timeout=CONNECT_TIMEOUT)
+
+    @timed('ssh/command')
+    def run(self, cmd, timeout=None, attempts=1):
+        """Run cmd in a login shell with a pty, as fabric's run does"""
+        channel = self._open_channel(attempts)
+        try:
+            channel.get_pty()
+            channel.exec_command('/bin/bash -l -c {}'.format(pipes.quote(cmd)))
+            channel.settimeout(self.poll_interval)
+
+            deadline = time.time() + timeout if timeout else None
+            chunks = []
+            while True:
+                try:
+                    data = channel.recv(self.bufsize)
+                except socket.timeout:
+                    data = None
+                if data == '':
+                    break
+                if data:
+                    chunks.append(data)
+                if deadline is not None and time.time() > deadline:
+                    metrics.incr('ssh/command_timeouts')
+                    raise CommandTimeout(timeout)
+            return CmdResult(''.join(chunks).strip(),
+                             channel.recv_exit_status())
+        finally:
+            channel.close()
+
+    def _sftp(self, attempts):
+        self.connect(attempts)
+        return self._client.open_sftp()
+
+    @timed('ssh/transfer')
+    def get(self, remote_path, local_path, attempts=1):
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path,
+                                      os.path.basename(remote_path))
+        sftp = self._sftp(attempts)
+        try:
+            sftp.get(remote_path, local_path)
+        finally:
+            sftp.close()
+        return local_path
+
+    @timed('ssh/transfer')
+    def put(self, local_path, remote_path, attempts=1):
+        sftp = self._sftp(attempts)
+        try:
+            try:
+                if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+                    remote_path = os.path.join(remote_path,
+                                               os.path.basename(local_path))
+            except IOError:
+                pass
+            sftp.put(local_path, remote_path)
+        finally:
+            sftp.close()
+        return remote_path
+
+
+class SSHPool(object):
+    """Sessions keyed by host and user, shared by all checkers"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._dropped_handshakes = {}
+        self._lock = threading.Lock()
+
+    def session(self, host, user, password):
+        key = (host, user)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.password != password:
+                if session is not None:
+                    self._retire(key)
+                session = SSHSession(host, user, password)
+                self._sessions[key] = session
+            return session
+
+    def _retire(self, key):
+        session = self._sessions.pop(key)
+        session.close()
+        self._dropped_handshakes[key] = (
+            self._dropped_handshakes.get(key, 0) + session.handshakes)
+
+    def drop(self, host, user):
+        """Close the connection to user@host, the next session reconnects"""
+        key = (host, user)
+        with self._lock:
+            if key in self._sessions:
+                self._retire(key)
+
+    def handshakes(self, host=None):
+        """Number of ssh handshakes done so far, per host"""
+        with self._lock:
+            counts = {}
+            for (h, _), count in self._dropped_handshakes.items():
+                counts[h] = counts.get(h, 0) + count
+            for (h, _), session in self._sessions.items():
+                counts[h] = counts.get(h, 0) + session.handshakes
+        if host is not None:
+            return counts.get(host, 0)
+        return counts
+
+
+ssh_pool = SSHPool()
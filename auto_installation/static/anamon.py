@@ -27,10 +27,13 @@ import sys
 import string
 import time
 import re
-import base64
 import shlex
+import socket
+import urllib
 import httplib
 import json
+import gzip
+import StringIO
 
 # on older installers (EL 2) we might not have xmlrpclib
 # and can't do logging, however this is more widely
@@ -54,8 +57,6 @@ class WatchedFile:
         self.alias = alias
         self.reset()
 
-        self._headers = {"Content-Type": "application/json", }
-
     def reset(self):
         self.where = 0
         self.last_size = 0
@@ -86,57 +87,90 @@ class WatchedFile:
         else:
             return 0
 
-    def _upload_log_data(self, name, alias, sz, offset, data):
-        json_data = json.dumps(dict(data=data))
-        conn = httplib.HTTPConnection(server_ip, server_port)
-
-        conn.request("GET", "/upload/{0}/{1}/{2}".format(stage, alias, offset),
-                     json_data, self._headers)
-        response = conn.getresponse()
-
-        conn.close()
-        # TODO handle response
-        return True
-
-    def uploadWrapper(self, blocksize=2621445):
-        """upload a file in chunks using the uploadFile call"""
-        retries = 3
+    def delta(self, blocksize):
+        """what was appended to the file since the last upload"""
         fo = file(self.fn, "r")
-        totalsize = os.path.getsize(self.fn)
-        ofs = 0
-        while True:
-            lap = time.time()
-            contents = fo.read(blocksize)
-            size = len(contents)
-            data = base64.encodestring(contents)
-            if size == 0:
-                offset = -1
-                sz = ofs
-            else:
-                offset = ofs
-                sz = size
-            del contents
-            tries = 0
-            while tries <= retries:
-                debug("upload_log_data('%s')\n" % (offset, ))
-                if self._upload_log_data(name, self.alias, sz, offset, data):
-                    break
-                else:
-                    tries = tries + 1
-            if size == 0:
-                break
-            ofs += size
-        fo.close()
+        try:
+            fo.seek(self.where)
+            return fo.read(blocksize)
+        finally:
+            fo.close()
 
-    def update(self):
+    def sent(self, size):
+        self.where += size
+
+    def update(self, shipper, blocksize=2621445):
         if not self.exists():
             return
-        if not self.changed():
+        # a delta which failed to ship, or didn't fit in one block, is still
+        # behind the size seen last time
+        if not self.changed() and self.where >= self.last_size:
             return
+        contents = self.delta(blocksize)
+        if contents:
+            shipper.add(self, contents)
+
+
+class LogShipper:
+    """send the deltas of all watched files in one request per tick
+
+    The request body is gzipped, every delta being a json header line
+    followed by its data. The connection is kept open between ticks.
+    """
+
+    def __init__(self, retries=3):
+        self.retries = retries
+        self.conn = None
+        self.pending = []
+        self.url = "/upload/batch"
+        if name:
+            self.url += "?name=" + urllib.quote(name)
+        self._headers = {"Content-Type": "application/octet-stream",
+                         "Content-Encoding": "gzip", }
+
+    def add(self, wf, data):
+        self.pending.append((wf, data))
+
+    def _body(self):
+        buf = StringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode="wb")
+        for wf, data in self.pending:
+            gz.write(json.dumps(dict(stage=stage, alias=wf.alias,
+                                     offset=wf.where, size=len(data))))
+            gz.write("\n")
+            gz.write(data)
+        gz.close()
+        return buf.getvalue()
+
+    def _post(self, body):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(server_ip, server_port)
         try:
-            self.uploadWrapper()
-        except:
-            raise
+            self.conn.request("POST", self.url, body, self._headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            # the server closed the connection, open a new one next time
+            self.conn.close()
+            self.conn = None
+            return False
+        return response.status == 200
+
+    def flush(self):
+        if not self.pending:
+            return
+        body = self._body()
+        tries = 0
+        while tries <= self.retries:
+            debug("upload_log_data(%d files, %d bytes)\n" % (
+                len(self.pending), len(body)))
+            if self._post(body):
+                for wf, data in self.pending:
+                    wf.sent(len(data))
+                break
+            tries = tries + 1
+        # offsets of failed deltas are kept, the next tick sends them again
+        self.pending = []
 
 
 class MountWatcher:
@@ -237,9 +271,11 @@ def anamon_loop():
         waitlist.extend(package_logs)
         waitlist.extend(bootloader_cfgs)
 
+    shipper = LogShipper()
+
     # Monitor loop
     while 1:
-        time.sleep(5)
+        time.sleep(interval)
 
         # Not all log files are available at the start, we'll loop through the
         # waitlist to determine when each file can be added to the watchlist
@@ -252,7 +288,8 @@ def anamon_loop():
 
         # Send any updates
         for wf in watchlist:
-            wf.update()
+            wf.update(shipper)
+        shipper.flush()
 
         # If asked to run_once, exit now
         if exit:
@@ -267,6 +304,7 @@ debug = lambda x, **y: None
 watchfiles = []
 exit = False
 stage = ""
+interval = 2
 
 # Process command-line args
 n = 0
@@ -289,6 +327,9 @@ while n < len(sys.argv):
     elif arg == '--port':
         n = n + 1
         server_port = sys.argv[n]
+    elif arg == '--interval':
+        n = n + 1
+        interval = float(sys.argv[n])
     elif arg == '--debug':
         debug = lambda x, **y: sys.stderr.write(x % y)
     elif arg == '--fg':
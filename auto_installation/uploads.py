@@ -0,0 +1,180 @@
+"""Writer for the installer logs anamon streams to the server
+
+Chunks are written at the offset they were read from on the host, into
+files which are never truncated, so chunks may arrive more than once or
+out of order without corrupting the log.
+
+A batch carries the chunks of several logs in one body, each one a json
+header line `{"stage": .., "alias": .., "offset": .., "size": ..}`
+followed by `size` bytes of the log.
+"""
+import os
+import json
+import time
+import zlib
+import threading
+from collections import OrderedDict, deque
+
+CHUNK_SIZE = 65536
+
+
+class GunzipStream(object):
+    """File-like view of the decompressed content of a gzipped stream"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buf = ''
+        self._eof = False
+
+    def _fill(self):
+        chunk = self._stream.read(CHUNK_SIZE)
+        if chunk:
+            self._buf += self._decomp.decompress(chunk)
+        else:
+            self._buf += self._decomp.flush()
+            self._eof = True
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self):
+        while not self._eof and '\n' not in self._buf:
+            self._fill()
+        end = self._buf.find('\n') + 1 or len(self._buf)
+        line, self._buf = self._buf[:end], self._buf[end:]
+        return line
+
+
+class LogChunkWriter(object):
+    """Keeps the uploaded log files open between chunks
+
+    A file not written for `idle_timeout` seconds is closed, as well as the
+    least recently written one when more than `max_open_files` are open.
+    """
+
+    def __init__(self, idle_timeout=300, max_open_files=64, rate_window=60):
+        self.idle_timeout = idle_timeout
+        self.max_open_files = max_open_files
+        self.rate_window = rate_window
+        self.bytes_total = 0
+        # path -> [fd, last write time], least recently written first
+        self._files = OrderedDict()
+        self._written = deque()
+        self._lock = threading.Lock()
+
+    def _fd(self, path):
+        entry = self._files.pop(path, None)
+        if entry is None:
+            log_path = os.path.dirname(path)
+            if not os.path.exists(log_path):
+                os.makedirs(log_path)
+            entry = [os.open(path, os.O_WRONLY | os.O_CREAT, 0644), None]
+        entry[1] = time.time()
+        self._files[path] = entry
+        return entry[0]
+
+    def _evict(self):
+        now = time.time()
+        while self._files:
+            path, (fd, last_write) = next(self._files.iteritems())
+            if (len(self._files) <= self.max_open_files and
+                    now - last_write < self.idle_timeout):
+                break
+            del self._files[path]
+            os.close(fd)
+
+    def _count(self, nbytes):
+        now = time.time()
+        self.bytes_total += nbytes
+        self._written.append((now, nbytes))
+        while self._written and now - self._written[0][0] > self.rate_window:
+            self._written.popleft()
+
+    def _write(self, path, offset, stream, size=None):
+        # reading the request may switch to another greenlet, only the
+        # writes of the chunks read are done under the lock
+        with self._lock:
+            self._fd(path)
+        written = 0
+        while size is None or written < size:
+            to_read = CHUNK_SIZE
+            if size is not None:
+                to_read = min(CHUNK_SIZE, size - written)
+            chunk = stream.read(to_read)
+            if not chunk:
+                break
+            with self._lock:
+                fd = self._fd(path)
+                os.lseek(fd, offset + written, os.SEEK_SET)
+                written += self._write_all(fd, chunk)
+                self._count(len(chunk))
+        with self._lock:
+            self._evict()
+        return written
+
+    def write(self, path, offset, stream, gzipped=False):
+        """Write everything read from stream into path, starting at offset"""
+        if gzipped:
+            stream = GunzipStream(stream)
+        return self._write(path, offset, stream)
+
+    def write_batch(self, log_path, stream, gzipped=False):
+        """Write every chunk of a batch under log_path/<stage>/<alias>
+
+        Returns the number of bytes written per `<stage>/<alias>`.
+        """
+        if gzipped:
+            stream = GunzipStream(stream)
+        written = {}
+        while True:
+            line = stream.readline()
+            if not line.strip():
+                break
+            header = json.loads(line)
+            name = os.path.join(os.path.basename(header['stage']),
+                                os.path.basename(header['alias']))
+            size = self._write(os.path.join(log_path, name),
+                               int(header['offset']), stream,
+                               int(header['size']))
+            if size < int(header['size']):
+                raise ValueError("batch truncated in {}".format(name))
+            written[name] = size
+        return written
+
+    @staticmethod
+    def _write_all(fd, data):
+        view = buffer(data)
+        while view:
+            view = view[os.write(fd, view):]
+        return len(data)
+
+    @property
+    def bytes_per_sec(self):
+        with self._lock:
+            now = time.time()
+            recent = sum(n for t, n in self._written
+                         if now - t <= self.rate_window)
+        return float(recent) / self.rate_window
+
+    def stats(self):
+        # close the files of hosts which are done uploading
+        with self._lock:
+            self._evict()
+            open_files = len(self._files)
+        return {
+            'bytes_per_sec': self.bytes_per_sec,
+            'bytes_total': self.bytes_total,
+            'open_files': open_files
+        }
+
+    def close(self):
+        with self._lock:
+            while self._files:
+                _, (fd, _) = self._files.popitem()
+                os.close(fd)
@@ -1,40 +1,115 @@
 import os
+import glob
 import json
+import logging
 from constants import PROJECT_ROOT
 from utils import init_redis
 
 LOGS_DIR = os.path.join(PROJECT_ROOT, 'logs') + '/'
+# logs/<date>/<time>/<build>/final_results.json
+RESULT_FILES = os.path.join(LOGS_DIR, '*', '*', '*', 'final_results.json')
 
+# set of dates which have a summary hash
+DATES_KEY = 'logs_summary:dates'
+# one hash per date, field `<time>__<build>` holds [ks dirs, sum]
+DATE_KEY_TPL = 'logs_summary:{}'
+# mtime of every result file already ingested, keyed by its path
+INGESTED_KEY = 'logs_summary:ingested'
 
-def walk_the_logs():
-    """=+_="""
-    summary = dict()
-    for dpath, dnames, files in os.walk(LOGS_DIR):
-        if 'final_results.json' in files:
-            index = files.index('final_results.json')
-            tmp = dpath.replace(LOGS_DIR, '').split('/')
-            date = tmp[0]
-            time_build = tmp[1] + '__' + tmp[2]
-            try:
-                final_res = json.load(
-                    open(os.path.join(dpath, files[index])))['sum']
-            except ValueError:
-                print("erros exists in file:: " + os.path.join(
-                    dpath, files[index]))
-                continue
+log = logging.getLogger('bender')
 
-            if summary.get(date, None):
-                summary[date][time_build] = [dnames, final_res]
-            else:
-                summary[date] = {time_build: [dnames, final_res]}
 
-    return summary
+def _mtime(path):
+    # stored as a string, keep the precision stable for comparing
+    return '%.6f' % os.path.getmtime(path)
+
+
+def _date_and_run(result_file):
+    """(date, `<time>__<build>`) of the run result_file belongs to"""
+    tmp = os.path.dirname(result_file).replace(LOGS_DIR, '').split('/')
+    return tmp[0], tmp[1] + '__' + tmp[2]
+
+
+def ingest_result_file(result_file, conn=None):
+    """Add one final_results.json to the summary index"""
+    conn = conn or init_redis()
+    dpath = os.path.dirname(result_file)
+    date, time_build = _date_and_run(result_file)
+    pipe = conn.pipeline()
+    pipe.hset(INGESTED_KEY, result_file, _mtime(result_file))
+    try:
+        final_res = json.load(open(result_file))['sum']
+    except ValueError:
+        log.error("erros exists in file:: %s", result_file)
+    else:
+        dnames = [
+            d for d in os.listdir(dpath)
+            if os.path.isdir(os.path.join(dpath, d))
+        ]
+        pipe.sadd(DATES_KEY, date)
+        pipe.hset(
+            DATE_KEY_TPL.format(date), time_build,
+            json.dumps([dnames, final_res]))
+    pipe.execute()
+
+
+def drop_result_file(result_file, conn=None):
+    """Remove a final_results.json which is gone from the summary index"""
+    conn = conn or init_redis()
+    date, time_build = _date_and_run(result_file)
+    date_key = DATE_KEY_TPL.format(date)
+    pipe = conn.pipeline()
+    pipe.hdel(INGESTED_KEY, result_file)
+    pipe.hdel(date_key, time_build)
+    pipe.execute()
+    if not conn.exists(date_key):
+        conn.srem(DATES_KEY, date)
 
 
 def cache_logs_summary():
+    """Ingest the result files written or changed since the last call, and
+    drop the ones deleted since"""
     conn = init_redis()
-    logs = json.dumps(walk_the_logs())
-    conn.set("logs_summary", logs)
+    ingested = conn.hgetall(INGESTED_KEY)
+    result_files = set(glob.glob(RESULT_FILES))
+    for result_file in result_files:
+        if ingested.get(result_file) != _mtime(result_file):
+            ingest_result_file(result_file, conn)
+    for result_file in set(ingested) - result_files:
+        drop_result_file(result_file, conn)
+
+
+def get_logs_summary(date_from=None, date_to=None, page=None, per_page=None):
+    """Summary of the indexed logs as {date: {time__build: [dnames, sum]}}
+
+    Dates are filtered by the inclusive range [date_from, date_to], newest
+    first, `page` starts with 1. Returns the summary and the number of
+    dates matching the filter.
+    """
+    conn = init_redis()
+    if not conn.exists(INGESTED_KEY):
+        log.info("no cache found, generate new cache")
+        cache_logs_summary()
+
+    dates = sorted(conn.smembers(DATES_KEY), reverse=True)
+    if date_from:
+        dates = [d for d in dates if d >= date_from]
+    if date_to:
+        dates = [d for d in dates if d <= date_to]
+    total = len(dates)
+
+    if per_page:
+        start = (max(page or 1, 1) - 1) * per_page
+        dates = dates[start:start + per_page]
+
+    pipe = conn.pipeline()
+    for date in dates:
+        pipe.hgetall(DATE_KEY_TPL.format(date))
+    summary = {}
+    for date, runs in zip(dates, pipe.execute()):
+        summary[date] = dict(
+            (time_build, json.loads(res)) for time_build, res in runs.items())
+    return summary, total
 
 
 if __name__ == "__main__":
@@ -1,10 +1,17 @@
 import os
+import copy
+import json
 import logging.config
 import yaml
 import redis
 import time
-import subprocess as sp
-from constants import PROJECT_ROOT, \
+import tempfile
+import threading
+import Queue
+import fnmatch
+from collections import OrderedDict
+from metrics import get_thread_metrics, set_thread_metrics
+from constants import PROJECT_ROOT, cfgjson, \
     TEST_LEVEL, \
     ANACONDA_TIER1, ANACONDA_TIER2, KS_TIER1, KS_TIER2, \
     UPGRADE_TIER1, UPGRADE_TIER2, VDSM_TIER, \
@@ -26,8 +33,97 @@ User::<{user_name_r}>, but currently reserved by User::<{user_name_w}>'''
                              .format(**message))
 
 
+class HostLogRouter(logging.Handler):
+    """Send every record to the log file chosen by the emitting thread
+
+    Each host of a job is served by its own worker thread, so one shared
+    FileHandler would mix the logs of all kickstarts running at the same
+    time. Threads which never chose a file use the most recent one. The
+    records of a thread working for a job also go to the log of the job.
+    """
+
+    max_open_files = 32
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self._local = threading.local()
+        self._handlers = OrderedDict()
+        self._handlers_lock = threading.Lock()
+        self._last_file = None
+
+    @property
+    def current_file(self):
+        return getattr(self._local, 'filename', None)
+
+    def set_file(self, filename):
+        self._local.filename = filename
+        self._last_file = filename
+
+    @property
+    def job_file(self):
+        return getattr(self._local, 'job_file', None)
+
+    def set_job_file(self, filename):
+        self._local.job_file = filename
+
+    def _get_handler(self, filename):
+        with self._handlers_lock:
+            handler = self._handlers.pop(filename, None)
+            if handler is None:
+                handler = logging.FileHandler(filename)
+                handler.setFormatter(self.formatter)
+            self._handlers[filename] = handler
+
+            while len(self._handlers) > self.max_open_files:
+                _, oldest = self._handlers.popitem(last=False)
+                oldest.close()
+            return handler
+
+    def emit(self, record):
+        filename = self.current_file or self._last_file
+        if filename:
+            self._get_handler(filename).handle(record)
+        job_file = self.job_file
+        if job_file and job_file != filename:
+            self._get_handler(job_file).handle(record)
+
+
+log_router = HostLogRouter()
+_logging_configured = False
+
+# log location of the kickstart the current thread is working on
+_thread_logs = threading.local()
+# test level of the job a thread works for
+_thread_job = threading.local()
+
+
+def get_thread_log_context():
+    return (getattr(_thread_logs, 'log_path', None),
+            getattr(_thread_logs, 'log_file', None),
+            getattr(_thread_logs, 'logger_name', None),
+            log_router.current_file,
+            log_router.job_file)
+
+
+def set_thread_log_context(ctx):
+    log_path, log_file, logger_name, filename, job_file = ctx
+    if log_path:
+        _thread_logs.log_path = log_path
+        _thread_logs.log_file = log_file
+    if logger_name:
+        _thread_logs.logger_name = logger_name
+    if filename:
+        log_router.set_file(filename)
+    log_router.set_job_file(job_file)
+
+
 class ResultsAndLogs(object):
     """This class will prepare logs directory structure
+
+    Every job has its own instance. Current log path, log file and logger
+    name are kept per thread, so the worker of every host writes into the
+    directory of its own kickstart. Readers outside of the workers get the
+    ones chosen most recently in the job.
     """
 
     def __init__(self):
@@ -38,6 +134,7 @@ class ResultsAndLogs(object):
         self.logger_dict = self.conf_to_dict()
         self._current_log_path = "/tmp/logs"
         self._current_log_file = "/tmp/logs"
+        self._host_log_paths = {}
         self._current_date = self.get_current_date()
         self._current_time = self.get_current_time()
 
@@ -51,19 +148,53 @@ class ResultsAndLogs(object):
 
     @property
     def logger_name(self):
-        return self._logger_name
+        return getattr(_thread_logs, 'logger_name', self._logger_name)
 
     @logger_name.setter
     def logger_name(self, val):
-        self._logger_name = val
+        _thread_logs.logger_name = val
 
     @property
     def current_log_path(self):
-        return self._current_log_path
+        return getattr(_thread_logs, 'log_path', self._current_log_path)
 
     @property
     def current_log_file(self):
-        return self._current_log_file
+        return getattr(_thread_logs, 'log_file', self._current_log_file)
+
+    def host_log_path(self, bkr_name):
+        """Log path of the kickstart currently running on bkr_name"""
+        return self._host_log_paths.get(bkr_name, self._current_log_path)
+
+    @property
+    def build_log_path(self):
+        """Directory the logs of all the kickstarts of the job are under"""
+        return os.path.join(self._logs_root_dir, self._current_date,
+                            self._current_time, self.parse_img_url())
+
+    @property
+    def job_log_file(self):
+        """Log of the job on all of its hosts, None before it's known"""
+        if self.img_url is None:
+            return None
+        return os.path.join(self.build_log_path, 'job.log')
+
+    def start_job_log(self):
+        """Copy the logs of the calling thread, and of the workers it
+        starts, into job_log_file"""
+        if not os.path.exists(self.build_log_path):
+            os.makedirs(self.build_log_path)
+        self._configure_logging()
+        log_router.set_job_file(self.job_log_file)
+
+    @property
+    def log_stamp(self):
+        """(date, time) directories the logs of this run are written under"""
+        return self._current_date, self._current_time
+
+    @log_stamp.setter
+    def log_stamp(self, val):
+        self._current_date, self._current_time = val
 
     def get_current_date(self):
         return time.strftime("%Y-%m-%d", time.localtime())
@@ -77,7 +208,21 @@ class ResultsAndLogs(object):
     def parse_img_url(self):
         return self.img_url.split('/')[-2]
 
-    def get_actual_logger(self, ks_name=''):
+    def _configure_logging(self):
+        global _logging_configured
+        if _logging_configured:
+            return
+        handlers = self.logger_dict['logging']['handlers']
+        logfile = handlers['logfile']
+        handlers['logfile'] = {
+            '()': lambda: log_router,
+            'formatter': logfile.get('formatter'),
+            'level': logfile.get('level', logging.NOTSET)
+        }
+        logging.config.dictConfig(self.logger_dict['logging'])
+        _logging_configured = True
+
+    def get_actual_logger(self, ks_name='', bkr_name=None):
         log_file = os.path.join(PROJECT_ROOT, 'logs',
                                 self._current_date,
                                 self._current_time,
@@ -86,13 +231,18 @@ class ResultsAndLogs(object):
         if not os.path.exists(log_file):
             os.system("mkdir -p {0}".format(os.path.dirname(log_file)))
 
-        self._current_log_path = os.path.dirname(log_file)
+        log_path = os.path.dirname(log_file)
+        self._current_log_path = log_path
         self._current_log_file = log_file
+        _thread_logs.log_path = log_path
+        _thread_logs.log_file = log_file
+        if bkr_name:
+            self._host_log_paths[bkr_name] = log_path
+            with _jobs_logs_lock:
+                _host_results_logs[bkr_name] = self
 
-        self.logger_dict['logging']['handlers']['logfile'][
-            'filename'] = log_file
-
-        logging.config.dictConfig(self.logger_dict['logging'])
+        self._configure_logging()
+        log_router.set_file(log_file)
 
     def del_existing_logs(self, ks_name=''):
         log_file = os.path.join(PROJECT_ROOT, 'logs',
@@ -105,6 +255,30 @@ class ResultsAndLogs(object):
 
 results_logs = ResultsAndLogs()
 
+_jobs_logs_lock = threading.Lock()
+# instance of the job running on every host, a host runs one job at a time
+_host_results_logs = {}
+# instance of the job started last
+_current_results_logs = [results_logs]
+
+
+def set_current_results_logs(logs):
+    """Make the logs of a starting job the ones the dashboard shows"""
+    with _jobs_logs_lock:
+        _current_results_logs[0] = logs
+
+
+def current_results_logs():
+    with _jobs_logs_lock:
+        return _current_results_logs[0]
+
+
+def host_log_path(bkr_name):
+    """Log path of the kickstart running on bkr_name, of whichever job"""
+    with _jobs_logs_lock:
+        logs = _host_results_logs.get(bkr_name, _current_results_logs[0])
+    return logs.host_log_path(bkr_name)
+
 
 def init_redis():
     pool = redis.ConnectionPool(
@@ -130,100 +304,394 @@ def init_kickstart_file(fn, args):
             fp.write(tpl)
 
 
+# keys which outlive a restart: job journals and queue, install done
+# messages and the logs summary index; host leases of the jobs which ran
+# before are dropped along with the rest
+PERSISTENT_KEYS = ('job:*', 'install_done:*', 'logs_summary:*')
+
+
 def setup_funcs(redis_conn):
-    print("flush all keys from current database")
-    redis_conn.flushdb()
+    print("remove all keys from current database but {}".format(
+        PERSISTENT_KEYS))
+    stale = [
+        k for k in redis_conn.scan_iter()
+        if not any(fnmatch.fnmatchcase(k, p) for p in PERSISTENT_KEYS)
+    ]
+    for i in range(0, len(stale), 1000):
+        redis_conn.delete(*stale[i:i + 1000])
+    # jobs running before the restart are gone, they can only be resumed
     print("set key 'running' value to '0'")
-    redis_conn.set('running', 0, nx=True)
-
-
-def get_testcase_map():
-    # get testcase map
-    testcase_map = {}
-    if TEST_LEVEL & ANACONDA_TIER1:
-        testcase_map.update(ANACONDA_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & ANACONDA_TIER2:
-        testcase_map.update(ANACONDA_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & KS_TIER1:
-        testcase_map.update(KS_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & KS_TIER2:
-        testcase_map.update(KS_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & DEBUG_TIER:
-        testcase_map.update(DEBUG_TIER_TESTCASE_MAP)
-    if TEST_LEVEL & UPGRADE_TIER1:
-        testcase_map.update(UPGRADE_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & UPGRADE_TIER2:
-        testcase_map.update(UPGRADE_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & VDSM_TIER:
-        testcase_map.update(VDSM_TIER_TESTCASE_MAP)
-
-    if not testcase_map:
-        raise ValueError('Invaild TEST_LEVEL')
-
-    return testcase_map
-
-
-def get_machine_ksl_map():
-    machine_ksl_map = {}
-    testcase_map = get_testcase_map()
-    for value in testcase_map.itervalues():
-        ks = value[0]
-        machine = value[1]
-        flag = False
-        if machine in machine_ksl_map:
-            if ks not in machine_ksl_map.get(machine):
-                flag = True
-        else:
-            machine_ksl_map[machine] = []
-            flag = True
-
-        if flag:
-            if ks in KS_PRESSURE_MAP:
-                ks_repeat_ls = [ks] * int(KS_PRESSURE_MAP.get(ks))
-                machine_ksl_map[machine].extend(ks_repeat_ls)
-            else:
-                machine_ksl_map[machine].append(ks)
-    for k in machine_ksl_map:
-        machine_ksl_map[k].sort()
-
-    return machine_ksl_map
-
-
-def get_ks_machine_map():
-    ks_mashine_map = {}
-    testcase_map = get_testcase_map()
-    for value in testcase_map.itervalues():
-        ks = value[0]
-        machine = value[1]
-        if ks in ks_mashine_map:
-            if machine != ks_mashine_map.get(ks):
-                raise ValueError(
-                    'One kickstart file %s cannot be run on two machines.' % ks)
-        else:
-            ks_mashine_map[ks] = machine
-
-    return ks_mashine_map
-
-
-def get_checkpoint_cases_map(ks, mc):
-    # get testcase map
-    testcase_map = get_testcase_map()
-
-    checkpoint_cases_map = {}
-    for key, value in testcase_map.items():
-        if set((ks, mc)) < set(value):
-            checkpoint = value[2]
-            if checkpoint in checkpoint_cases_map:
-                checkpoint_cases_map[checkpoint].append(key)
-            else:
-                checkpoint_cases_map[checkpoint] = []
-                checkpoint_cases_map[checkpoint].append(key)
-
-    return checkpoint_cases_map
-
-
-def get_lastline_of_file(file_path):
-    return sp.check_output(['tail', '-1', file_path])
+    redis_conn.set('running', 0)
+
+
+# tier flag and testcase map of every tier, in the order they're merged
+TIER_TESTCASE_MAPS = (
+    (ANACONDA_TIER1, ANACONDA_TIER1_TESTCASE_MAP),
+    (ANACONDA_TIER2, ANACONDA_TIER2_TESTCASE_MAP),
+    (KS_TIER1, KS_TIER1_TESTCASE_MAP),
+    (KS_TIER2, KS_TIER2_TESTCASE_MAP),
+    (DEBUG_TIER, DEBUG_TIER_TESTCASE_MAP),
+    (UPGRADE_TIER1, UPGRADE_TIER1_TESTCASE_MAP),
+    (UPGRADE_TIER2, UPGRADE_TIER2_TESTCASE_MAP),
+    (VDSM_TIER, VDSM_TIER_TESTCASE_MAP),
+)
+
+
+class TestcaseIndex(object):
+    """Testcase map of one test level with its lookups computed up front
+
+    The index never changes once built, every lookup hands out a copy.
+    """
+
+    def __init__(self, test_level):
+        self.test_level = test_level
+
+        testcase_map = {}
+        for tier, tier_map in TIER_TESTCASE_MAPS:
+            if test_level & tier:
+                testcase_map.update(tier_map)
+        if not testcase_map:
+            raise ValueError('Invaild TEST_LEVEL')
+        self._testcase_map = testcase_map
+
+        self._ks_machine_map = {}
+        self._ks_machine_error = None
+        self._machine_ksl_map = {}
+        self._checkpoint_cases_maps = {}
+
+        for case, value in testcase_map.iteritems():
+            ks, machine, checkpoint = value[0], value[1], value[2]
+
+            if ks not in self._ks_machine_map:
+                self._ks_machine_map[ks] = machine
+            elif self._ks_machine_map[ks] != machine:
+                self._ks_machine_error = (
+                    'One kickstart file %s cannot be run on two machines.' %
+                    ks)
+
+            ksl = self._machine_ksl_map.setdefault(machine, [])
+            if ks not in ksl:
+                ksl.extend([ks] * int(KS_PRESSURE_MAP.get(ks, 1)))
+
+            checkpoint_cases_map = self._checkpoint_cases_maps.setdefault(
+                (ks, machine), {})
+            checkpoint_cases_map.setdefault(checkpoint, []).append(case)
+
+        for ksl in self._machine_ksl_map.values():
+            ksl.sort()
+
+    def testcase_map(self):
+        return dict(self._testcase_map)
+
+    def machine_ksl_map(self):
+        return dict((machine, list(ksl))
+                    for machine, ksl in self._machine_ksl_map.items())
+
+    def ks_machine_map(self):
+        if self._ks_machine_error:
+            raise ValueError(self._ks_machine_error)
+        return dict(self._ks_machine_map)
+
+    def checkpoint_cases_map(self, ks, mc):
+        checkpoint_cases_map = self._checkpoint_cases_maps.get((ks, mc), {})
+        return dict((checkpoint, list(cases))
+                    for checkpoint, cases in checkpoint_cases_map.items())
+
+
+_testcase_indexes = {}
+_testcase_indexes_lock = threading.Lock()
+# mtime of constants.json and the test level read from it
+_cfg_state = [None, TEST_LEVEL]
+
+
+def set_thread_test_level(test_level):
+    """Make test_level the current one of the calling thread's job"""
+    _thread_job.test_level = test_level
+
+
+def get_current_test_level():
+    """Test level of the calling thread's job, if it set one, else the
+    one in constants.json, which is rewritten by job launches"""
+    test_level = getattr(_thread_job, 'test_level', None)
+    if test_level is not None:
+        return test_level
+
+    try:
+        mtime = os.path.getmtime(cfgjson)
+    except OSError:
+        return _cfg_state[1]
+
+    with _testcase_indexes_lock:
+        if mtime != _cfg_state[0]:
+            _cfg_state[1] = json_files.load(cfgjson)['test_level']
+            _cfg_state[0] = mtime
+            _testcase_indexes.clear()
+        return _cfg_state[1]
+
+
+def get_testcase_index(test_level=None):
+    if test_level is None:
+        test_level = get_current_test_level()
+
+    with _testcase_indexes_lock:
+        index = _testcase_indexes.get(test_level)
+        if index is None:
+            index = TestcaseIndex(test_level)
+            _testcase_indexes[test_level] = index
+        return index
+
+
+def get_testcase_map(test_level=None):
+    return get_testcase_index(test_level).testcase_map()
+
+
+def get_machine_ksl_map(test_level=None):
+    return get_testcase_index(test_level).machine_ksl_map()
+
+
+def get_ks_machine_map(test_level=None):
+    return get_testcase_index(test_level).ks_machine_map()
+
+
+def get_checkpoint_cases_map(ks, mc, test_level=None):
+    return get_testcase_index(test_level).checkpoint_cases_map(ks, mc)
+
+
+def run_concurrently(func, items, max_workers):
+    """Call func with every item of items from at most max_workers threads
+
+    Results are returned in the order of items, an exception raised by func
+    is returned in place of its result. Worker threads keep logging into
+    the files of the calling thread until they choose their own, and share
+    its test level and job metrics.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    tasks = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+    log_ctx = get_thread_log_context()
+    test_level = getattr(_thread_job, 'test_level', None)
+    job_metrics = get_thread_metrics()
+
+    def worker():
+        set_thread_log_context(log_ctx)
+        set_thread_test_level(test_level)
+        set_thread_metrics(job_metrics)
+        while True:
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                log.exception(e)
+                results[index] = e
+
+    threads = [
+        threading.Thread(target=worker)
+        for _ in range(max(1, min(max_workers, len(items))))
+    ]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class BackgroundTasks(object):
+    """Calls the submitted functions from at most max_workers threads
+
+    Every call logs into the files, and runs with the test level and job
+    metrics, of the thread which submitted it. Exceptions are logged,
+    join() waits for all the calls submitted so far and stops the workers.
+    Workers also quit once idle for idle_timeout seconds; without any the
+    calls are made right away by the submitter.
+    """
+    # bound here, the module globals are gone when the interpreter exits
+    _Empty = Queue.Empty
+
+    def __init__(self, max_workers=1, idle_timeout=60):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._tasks = Queue.Queue()
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        if self.max_workers < 1:
+            try:
+                func(*args)
+            except Exception as e:
+                log.exception(e)
+            return
+
+        task = (get_thread_log_context(),
+                getattr(_thread_job, 'test_level', None),
+                get_thread_metrics(), func, args)
+        with self._lock:
+            self._tasks.put(task)
+            if self._workers < self.max_workers:
+                t = threading.Thread(target=self._work)
+                t.setDaemon(True)
+                t.start()
+                self._workers += 1
+
+    def _work(self):
+        while True:
+            try:
+                task = self._tasks.get(timeout=self.idle_timeout)
+            except self._Empty:
+                # tasks are put under the lock, none can be left behind
+                with self._lock:
+                    if self._tasks.empty():
+                        self._workers -= 1
+                        return
+                continue
+            except Exception:
+                # the interpreter is exiting, don't print about it
+                return
+            if task is None:
+                # stopped by join()
+                self._tasks.task_done()
+                return
+            log_ctx, test_level, job_metrics, func, args = task
+            try:
+                set_thread_log_context(log_ctx)
+                set_thread_test_level(test_level)
+                set_thread_metrics(job_metrics)
+                func(*args)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                self._tasks.task_done()
+
+    def join(self):
+        self._tasks.join()
+        with self._lock:
+            for _ in range(self._workers):
+                self._tasks.put(None)
+            self._workers = 0
+
+
+def write_atomically(path, content, mode=0644):
+    """Replace path with content, readers get either the old or the new"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(content)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JsonFiles(object):
+    """Contents of json files, read again only once the files change
+
+    Readers get copies, which they may modify. Writes replace a file
+    atomically, one at a time; update() reads and writes under the same
+    lock, so concurrent updates of a file don't lose each other's changes.
+    At most `max_entries` files are cached, the least recently read ones
+    are dropped first.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        # path -> (stamp of the file, contents), least recently read first
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def load(self, path):
+        try:
+            stamp = self._stamp(path)
+        except OSError:
+            with self._lock:
+                self._cache.pop(path, None)
+            raise
+        with self._lock:
+            cached = self._cache.pop(path, None)
+            if cached is None or cached[0] != stamp:
+                with open(path) as fp:
+                    cached = (stamp, json.load(fp))
+            self._cache[path] = cached
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            return copy.deepcopy(cached[1])
+
+    def dump(self, path, data, indent=None):
+        content = json.dumps(data, indent=indent)
+        with self._lock:
+            write_atomically(path, content)
+            self._cache.pop(path, None)
+
+    def update(self, path, **changes):
+        """Set changes in the json object of path, return all of it"""
+        with self._lock:
+            data = self.load(path)
+            data.update(changes)
+            self.dump(path, data)
+            return data
+
+
+json_files = JsonFiles()
+
+
+class TTLCache(object):
+    """Values of loader(*args), refreshed in the background once stale
+
+    A stale value is still returned while a thread loads the new one, so
+    only the very first call for some args waits for the loader.
+    """
+
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        # args -> (value, load time)
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _load(self, args):
+        value = self.loader(*args)
+        with self._lock:
+            self._entries[args] = (value, time.time())
+        return value
+
+    def _refresh(self, args):
+        try:
+            self._load(args)
+        except Exception as e:
+            log.exception(e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(args)
+
+    def get(self, *args):
+        with self._lock:
+            entry = self._entries.get(args)
+            if entry is not None and time.time() - entry[1] > self.ttl \
+                    and args not in self._refreshing:
+                self._refreshing.add(args)
+                t = threading.Thread(target=self._refresh, args=(args, ))
+                t.setDaemon(True)
+                t.start()
+        if entry is None:
+            return self._load(args)
+        return entry[0]
 
 
 if __name__ == '__main__':
@@ -1,7 +1,10 @@
-from auto_installation import app, setup_funcs, rd_conn
+from auto_installation import app, setup_funcs, rd_conn, dispatcher, \
+    status_poller
 from gevent.pywsgi import WSGIServer
 
 if __name__ == '__main__':
     setup_funcs(rd_conn)
+    dispatcher.start()
+    status_poller.start()
     srv = WSGIServer(('', 5000), app)
     srv.serve_forever()
@@ -0,0 +1,11 @@
+import os
+import redis
+
+# the server keeps its jobs in db 0, the tests get a db of their own; give
+# the password in the url if the redis asks for one
+REDIS_URL = os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15')
+
+
+def isolated_redis():
+    """Connection to the redis db the tests are free to write to"""
+    return redis.StrictRedis.from_url(REDIS_URL)
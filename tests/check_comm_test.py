@@ -0,0 +1,46 @@
+import os
+import sys
+from nose.tools import ok_, eq_
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.check_comm import frame_cmds, parse_framed_output, \
+                                         FRAME_TAG
+
+
+def _framed(nonce, index, output, code):
+    return "{0} {1} begin {2}\r\n{3}\r\n{0} {1} end {2} {4}".format(
+        FRAME_TAG, nonce, index, output, code)
+
+
+def test_frame_cmds_marks_every_cmd():
+    script = frame_cmds(['uptime', 'exit 3'], 'n0nce')
+    ok_("begin 0" in script)
+    ok_("end 1" in script)
+    ok_("'exit 3'" in script)
+
+
+def test_parse_framed_output():
+    output = '\r\n'.join([
+        _framed('n0nce', 0, 'line1\r\nline2', 0),
+        _framed('n0nce', 1, 'No such file', 2)
+    ])
+    rets = parse_framed_output(output, 'n0nce', 2)
+    eq_(rets[0], 'line1\r\nline2')
+    ok_(rets[0].succeeded)
+    eq_(rets[1], 'No such file')
+    eq_(rets[1].return_code, 2)
+    ok_(rets[1].failed)
+
+
+def test_parse_framed_output_without_end_marker():
+    output = "{} n0nce begin 0\r\npartial".format(FRAME_TAG)
+    rets = parse_framed_output(output, 'n0nce', 2)
+    eq_(rets[0], 'partial')
+    eq_(rets[0].return_code, -1)
+    eq_(rets[1], '')
+    ok_(rets[1].failed)
+
+
+def test_parse_framed_output_ignores_other_nonce():
+    output = _framed('other', 0, 'x', 0)
+    rets = parse_framed_output(output, 'n0nce', 1)
+    eq_(rets[0].return_code, -1)
@@ -0,0 +1,103 @@
+import os
+import sys
+from nose.tools import ok_, eq_, with_setup
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.dispatch import Dispatcher, HostLeases, JOB_QUEUE_KEY
+from auto_installation.journal import JobJournal
+from tests import isolated_redis
+
+HOSTS_OF_LEVEL = {
+    '1': set(['test-host-01', 'test-host-02']),
+    '2': set(['test-host-03']),
+    '3': set(['test-host-02', 'test-host-03']),
+}
+ALL_HOSTS = set.union(*HOSTS_OF_LEVEL.values())
+
+rd_conn = None
+disp = None
+# ids of the jobs the test created, and of those started
+jobs = None
+started = None
+
+
+def setup_dispatcher():
+    global rd_conn, disp, jobs, started
+    rd_conn = isolated_redis()
+    disp = Dispatcher(rd_conn)
+    disp.hosts_of = lambda info: HOSTS_OF_LEVEL[info['test_level']]
+    # other jobs in the queue are left alone
+    disp.queued = lambda: [
+        job_id for job_id in Dispatcher.queued(disp) if job_id in jobs]
+    jobs = []
+    started = []
+    disp._start_job = lambda journal, info, hosts: started.append(
+        journal.job_id)
+
+
+def teardown_dispatcher():
+    for job_id in jobs:
+        journal = JobJournal(job_id, rd_conn)
+        journal.finish()
+        rd_conn.delete(journal.key, journal.steps_key)
+        rd_conn.zrem(JOB_QUEUE_KEY, job_id)
+        disp.leases.release(job_id, ALL_HOSTS)
+
+
+def _submit(img_url, **kwargs):
+    job_id = disp.submit(img_url, **kwargs)
+    jobs.append(job_id)
+    return job_id
+
+
+@with_setup(setup_dispatcher, teardown_dispatcher)
+def test_queue_is_ordered_by_priority_then_submission():
+    low = _submit('http://x/low/img', test_level=1)
+    high = _submit('http://x/high/img', test_level=1, priority=5)
+    later = _submit('http://x/later/img', test_level=1)
+    eq_(disp.queued(), [high, low, later])
+
+
+@with_setup(setup_dispatcher, teardown_dispatcher)
+def test_waiting_job_blocks_its_hosts_for_later_ones():
+    first = _submit('http://x/first/img', test_level=1)
+    waiting = _submit('http://x/waiting/img', test_level=3)
+    later = _submit('http://x/later/img', test_level=2)
+    disp.tick()
+    # waiting needs test-host-02 held by first, later wants its test-host-03
+    eq_(started, [first])
+    eq_(disp.queued(), [waiting, later])
+
+
+def test_leases_are_all_or_nothing():
+    leases = HostLeases(isolated_redis())
+    try:
+        ok_(leases.acquire('job-a', ['test-host-01', 'test-host-02']))
+        ok_(not leases.acquire('job-b', ['test-host-02', 'test-host-03']))
+        # test-host-03 was free, but isn't taken either
+        eq_(leases.holders().get('test-host-03'), None)
+        eq_(leases.renew('job-a', ['test-host-01', 'test-host-02']), 2)
+        eq_(leases.renew('job-b', ['test-host-02']), 0)
+        leases.release('job-b', ['test-host-01'])
+        eq_(leases.holders().get('test-host-01'), 'job-a')
+    finally:
+        leases.release('job-a', ['test-host-01', 'test-host-02'])
+    ok_(leases.acquire('job-b', ['test-host-02', 'test-host-03']))
+    leases.release('job-b', ['test-host-02', 'test-host-03'])
+
+
+@with_setup(setup_dispatcher, teardown_dispatcher)
+def test_resume_requeues_only_jobs_not_running():
+    journal = JobJournal.create(rd_conn, img_url='http://x/y/img',
+                                test_level=2)
+    jobs.append(journal.job_id)
+    ok_(journal.job_id in
+        [j.job_id for j in JobJournal.unfinished(rd_conn)])
+
+    disp._running[journal.job_id] = HOSTS_OF_LEVEL['2']
+    ok_(not disp.requeue(journal))
+    eq_(disp.queued(), [])
+
+    del disp._running[journal.job_id]
+    ok_(disp.requeue(journal))
+    eq_(disp.queued(), [journal.job_id])
+    eq_(journal.info['status'], 'queued')
@@ -0,0 +1,30 @@
+import os
+import sys
+from nose.tools import eq_
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.events import EventHub, CHECKPOINT_CHANNEL
+
+
+def test_events_are_fanned_out_to_every_client():
+    hub = EventHub(hosts=['host-01'])
+    clients = [hub.subscribe(), hub.subscribe()]
+    hub.dispatch('host-01', 'done,10.0.0.1')
+    hub.dispatch(CHECKPOINT_CHANNEL, '{"checkpoint": "iqn_check"}')
+    for client in clients:
+        event = client.popleft()
+        eq_((event['type'], event['host'], event['data']),
+            ('install', 'host-01', 'done,10.0.0.1'))
+        event = client.popleft()
+        eq_((event['type'], event['data']),
+            ('checkpoint', {'checkpoint': 'iqn_check'}))
+
+    hub.unsubscribe(clients[0])
+    eq_(hub.clients(), 1)
+
+
+def test_slow_client_keeps_the_latest_events():
+    hub = EventHub(hosts=['host-01'], maxlen=2)
+    client = hub.subscribe()
+    for i in range(3):
+        hub.dispatch('host-01-cockpit', str(i))
+    eq_([e['data'] for e in client], [1, 2])
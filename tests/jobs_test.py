@@ -0,0 +1,65 @@
+import os
+import sys
+from nose.tools import eq_, with_setup
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.jobs import JobRunner
+from auto_installation.journal import JobJournal, CHECKED, FAILED
+from tests import isolated_redis
+
+rd_conn = None
+journal = None
+
+
+class FakeResultsAndLogs(object):
+    logger_name = None
+
+    def get_actual_logger(self, ks, m):
+        pass
+
+
+class InstallRecorder(JobRunner):
+    """Records the kickstarts installed, the installations fail"""
+
+    def _install(self, m, ks, n, step):
+        self.installed.append((ks, n))
+        return None
+
+
+def setup_journal():
+    global rd_conn, journal
+    rd_conn = isolated_redis()
+    journal = JobJournal.create(rd_conn, img_url='http://x/y/z.squashfs')
+
+
+def teardown_journal():
+    journal.finish()
+    rd_conn.delete(journal.key, journal.steps_key)
+
+
+def _runner():
+    runner = InstallRecorder('http://x/y/z.squashfs', rd_conn,
+                             FakeResultsAndLogs(), None, journal=journal)
+    runner.installed = []
+    return runner
+
+
+@with_setup(setup_journal, teardown_journal)
+def test_repeated_ks_runs_every_time():
+    runner = _runner()
+    runner._run_host_queue(('host-01', ['ati_fc_04.ks', 'ati_local_01.ks',
+                                        'ati_fc_04.ks', 'ati_fc_04.ks']))
+    eq_(runner.installed, [('ati_fc_04.ks', 0), ('ati_local_01.ks', 1),
+                           ('ati_fc_04.ks', 2), ('ati_fc_04.ks', 3)])
+    eq_(sorted(journal.steps()), [('host-01', 'ati_fc_04.ks', 0),
+                                  ('host-01', 'ati_fc_04.ks', 2),
+                                  ('host-01', 'ati_fc_04.ks', 3),
+                                  ('host-01', 'ati_local_01.ks', 1)])
+
+
+@with_setup(setup_journal, teardown_journal)
+def test_resumed_job_skips_only_finished_runs():
+    journal.record('host-01', 'ati_fc_04.ks', 0, CHECKED)
+    journal.record('host-01', 'ati_fc_04.ks', 1, FAILED)
+    runner = _runner()
+    runner._run_host_queue(('host-01', ['ati_fc_04.ks'] * 3))
+    eq_(runner.installed, [('ati_fc_04.ks', 1), ('ati_fc_04.ks', 2)])
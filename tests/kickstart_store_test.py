@@ -0,0 +1,31 @@
+import os
+import sys
+from nose.tools import ok_, eq_
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.kickstarts import KickStartStore
+
+
+def test_ks_store_keeps_current_contents():
+    store = KickStartStore(max_entries=2)
+    first = store.put('ati_local_01.ks', 'rev1')
+    store.put('ati_local_01.ks', 'rev2')
+    store.put('ati_local_02.ks', 'rev1')
+    store.put('ati_local_03.ks', 'rev3')
+    eq_(store.get(first), 'rev1')
+    eq_(store.url_path('ati_local_03.ks'),
+        '/ks/' + store.hash_of('ati_local_03.ks'))
+    ok_(store.get(store.hash_of('ati_local_01.ks')) == 'rev2')
+    eq_(store.url_path('ati_nfs.ks'), '/static/auto/ati_nfs.ks')
+
+
+def test_ks_store_keeps_pinned_contents_until_released():
+    store = KickStartStore(max_entries=1)
+    old = store.put('ati_local_01.ks', 'build1', 'job1')
+    new = store.put('ati_local_01.ks', 'build2', 'job2')
+    store.put('ati_local_02.ks', 'build2', 'job2')
+    eq_(store.get(old), 'build1')
+    eq_(store.pinned_names(), set(['ati_local_01.ks', 'ati_local_02.ks']))
+
+    store.release('job1')
+    eq_(store.get(old), None)
+    eq_(store.get(new), 'build2')
@@ -0,0 +1,50 @@
+import os
+import sys
+import shutil
+import tempfile
+from nose.tools import eq_, with_setup
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.logtail import LogTail
+
+tmp_dir = None
+
+
+def setup_tmp():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_tmp():
+    shutil.rmtree(tmp_dir)
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_follow_appended_lines():
+    log_file = os.path.join(tmp_dir, 'results')
+    with open(log_file, 'w') as fp:
+        fp.write('line1\nline2\npart')
+    tail = LogTail(lambda: log_file, maxlen=2)
+    tail.refresh()
+    eq_(tail.lines(5), ['line1\n', 'line2\n'])
+
+    seq = tail.seq
+    with open(log_file, 'a') as fp:
+        fp.write('ial\nline4\n')
+    tail.refresh()
+    eq_(tail.lines(5), ['partial\n', 'line4\n'])
+    eq_(tail.since(seq), (['partial\n', 'line4\n'], seq + 2))
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_switch_to_the_new_current_file():
+    current = [os.path.join(tmp_dir, 'a')]
+    with open(current[0], 'w') as fp:
+        fp.write('a\n')
+    tail = LogTail(lambda: current[0])
+    tail.refresh()
+
+    current[0] = os.path.join(tmp_dir, 'b')
+    with open(current[0], 'w') as fp:
+        fp.write('b\n')
+    tail.refresh()
+    eq_(tail.lines(5), ['b\n'])
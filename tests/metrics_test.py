@@ -0,0 +1,41 @@
+import os
+import sys
+from nose.tools import ok_, eq_
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.metrics import Metrics, set_thread_metrics
+
+
+def test_spans_aggregate_by_name():
+    m = Metrics()
+    m.record('checkpoint/iqn_check', 1.0)
+    m.record('checkpoint/iqn_check', 3.0)
+    spans = m.snapshot()['spans']
+    eq_(spans['checkpoint/iqn_check']['count'], 2)
+    eq_(spans['checkpoint/iqn_check']['avg'], 2.0)
+    eq_(spans['checkpoint/iqn_check']['max'], 3.0)
+
+
+def test_span_is_recorded_on_error():
+    m = Metrics()
+    try:
+        with m.span('provision'):
+            raise ValueError()
+    except ValueError:
+        pass
+    m.incr('installs/failed')
+    snapshot = m.snapshot()
+    ok_('provision' in snapshot['spans'])
+    eq_(snapshot['counters'], {'installs/failed': 1})
+
+
+def test_job_metrics_get_the_records_of_their_thread():
+    m = Metrics()
+    job = Metrics()
+    set_thread_metrics(job)
+    try:
+        m.incr('installs/done')
+    finally:
+        set_thread_metrics(None)
+    m.incr('installs/done')
+    eq_(job.snapshot()['counters'], {'installs/done': 1})
+    eq_(m.snapshot()['counters'], {'installs/done': 2})
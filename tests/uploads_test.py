@@ -0,0 +1,77 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+from StringIO import StringIO
+from nose.tools import eq_, with_setup
+sys.path.insert(0, os.path.abspath("../auto_installation"))
+from auto_installation.uploads import LogChunkWriter
+
+tmp_dir = None
+
+
+def setup_tmp():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_tmp():
+    shutil.rmtree(tmp_dir)
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_write_at_offset_without_truncating():
+    writer = LogChunkWriter()
+    log_file = os.path.join(tmp_dir, 'pre', 'anaconda.log')
+    writer.write(log_file, 0, StringIO('line1\nline2\n'))
+    writer.write(log_file, 6, StringIO('LINE2\n'))
+    writer.close()
+    eq_(open(log_file).read(), 'line1\nLINE2\n')
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_write_gzipped_chunk():
+    writer = LogChunkWriter()
+    log_file = os.path.join(tmp_dir, 'sys.log')
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.write('x' * 100)
+    gz.close()
+    eq_(writer.write(log_file, 0, StringIO(buf.getvalue()), gzipped=True),
+        100)
+    eq_(writer.stats()['bytes_total'], 100)
+    writer.close()
+    eq_(open(log_file).read(), 'x' * 100)
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_least_recently_written_file_is_closed():
+    writer = LogChunkWriter(max_open_files=2)
+    for name in ('a', 'b', 'c'):
+        writer.write(os.path.join(tmp_dir, name), 0, StringIO(name))
+    eq_(writer.stats()['open_files'], 2)
+    writer.close()
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_write_batch():
+    writer = LogChunkWriter()
+    body = ''.join([
+        '{"stage": "pre", "alias": "anaconda.log", "offset": 0, "size": 4}\n',
+        'abc\n',
+        '{"stage": "pre", "alias": "sys.log", "offset": 2, "size": 3}\n',
+        'xyz'
+    ])
+    written = writer.write_batch(tmp_dir, StringIO(body))
+    writer.close()
+    eq_(written, {'pre/anaconda.log': 4, 'pre/sys.log': 3})
+    eq_(open(os.path.join(tmp_dir, 'pre', 'sys.log')).read(), '\0\0xyz')
+
+
+@with_setup(setup_tmp, teardown_tmp)
+def test_idle_files_are_closed_on_stats():
+    writer = LogChunkWriter(idle_timeout=0)
+    writer.write(os.path.join(tmp_dir, 'a'), 0, StringIO('a'))
+    eq_(writer.stats()['open_files'], 0)
+    eq_(writer.stats()['bytes_total'], 1)
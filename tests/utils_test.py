@@ -1,4 +1,139 @@
 import time
+import os
+import shutil
+import tempfile
+import threading
+from nose.tools import ok_, eq_
+from auto_installation import utils
+from auto_installation.utils import BackgroundTasks, JsonFiles
+from auto_installation.constants import ANACONDA_TIER1, KS_TIER1, KS_TIER2
+from auto_installation.const_install import KS_PRESSURE_MAP
+
+
+def test_testcase_index_is_cached_per_level():
+    ok_(utils.get_testcase_index(KS_TIER1) is
+        utils.get_testcase_index(KS_TIER1))
+
+
+def test_testcase_index_lookups_are_copies():
+    index = utils.TestcaseIndex(ANACONDA_TIER1)
+    ksl_map = index.machine_ksl_map()
+    for ksl in ksl_map.values():
+        del ksl[:]
+    eq_(ksl_map.keys(), index.machine_ksl_map().keys())
+    ok_(all(index.machine_ksl_map().values()))
+
+
+def test_testcase_index_checkpoint_cases():
+    index = utils.TestcaseIndex(ANACONDA_TIER1 | KS_TIER1)
+    for case, (ks, machine, checkpoint) in index.testcase_map().items():
+        ok_(case in index.checkpoint_cases_map(ks, machine)[checkpoint])
+        ok_(ks in index.machine_ksl_map()[machine])
+
+
+def test_testcase_index_repeats_pressure_ks():
+    index = utils.TestcaseIndex(KS_TIER2 | KS_TIER1 | ANACONDA_TIER1)
+    for ksl in index.machine_ksl_map().values():
+        for ks, num in KS_PRESSURE_MAP.items():
+            if ks in ksl:
+                eq_(ksl.count(ks), int(num))
+
+
+def test_background_tasks_run_with_the_test_level_of_the_submitter():
+    tasks = BackgroundTasks(2)
+    levels = []
+
+    def task(i):
+        levels.append(utils.get_current_test_level())
+        if i == 0:
+            raise ValueError(i)
+
+    utils.set_thread_test_level(KS_TIER1)
+    try:
+        for i in range(4):
+            tasks.submit(task, i)
+        tasks.join()
+    finally:
+        utils.set_thread_test_level(None)
+    eq_(levels, [KS_TIER1] * 4)
+
+
+def test_json_files_updates_are_serialized():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cfg = os.path.join(tmp_dir, 'constants.json')
+        files = JsonFiles()
+        files.dump(cfg, {'test_level': 1})
+        eq_(files.load(cfg), {'test_level': 1})
+
+        threads = [
+            threading.Thread(target=files.update, args=(cfg, ),
+                             kwargs={'k%d' % i: i}) for i in range(10)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        data = files.load(cfg)
+        eq_(len(data), 11)
+
+        # readers get copies
+        data['test_level'] = 2
+        eq_(files.load(cfg)['test_level'], 1)
+        eq_(os.listdir(tmp_dir), ['constants.json'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# whole seconds, which os.utime sets exactly
+MTIME = 1500000000
+
+
+def _dump(files, path, data):
+    files.dump(path, data)
+    os.utime(path, (MTIME, MTIME))
+
+
+def _rewrite_keeping_stamp(path, content):
+    """Change the contents of path, its size and mtime stay the same"""
+    with open(path, 'r+') as fp:
+        fp.write(content)
+    os.utime(path, (MTIME, MTIME))
+
+
+def test_json_files_reread_changed_files():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'final_results.json')
+        files = JsonFiles()
+        _dump(files, path, {'i': 1})
+        eq_(files.load(path), {'i': 1})
+
+        _rewrite_keeping_stamp(path, '{"i": 2}')
+        eq_(files.load(path), {'i': 1})
+
+        os.utime(path, (MTIME, MTIME + 10))
+        eq_(files.load(path), {'i': 2})
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_json_files_cache_is_bounded():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = JsonFiles(max_entries=2)
+        paths = [os.path.join(tmp_dir, '%d.json' % i) for i in range(3)]
+        for i, path in enumerate(paths):
+            _dump(files, path, {'i': i})
+            eq_(files.load(path), {'i': i})
+        for i, path in enumerate(paths):
+            _rewrite_keeping_stamp(path, '{"i": %d}' % (i + 5))
+
+        # the least recently read file is gone from the cache, read again
+        eq_(files.load(paths[0]), {'i': 5})
+        eq_(files.load(paths[2]), {'i': 2})
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 def ptime():